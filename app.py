@@ -2,12 +2,26 @@ import streamlit as st
 import gspread
 from google.oauth2.service_account import Credentials
 import googleapiclient.discovery
+import google.auth.transport.requests
 import google.generativeai as genai
-import pandas as pd
 import re
+import os
 import json
-from datetime import datetime
-from collections import OrderedDict
+import math
+import sqlite3
+import atexit
+import hashlib
+import hmac
+import random
+import uuid
+import threading
+import time
+import functools
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
 # ----------------------------------------------------------------------
 # 초기 설정 및 페이지 구성
@@ -18,66 +32,1345 @@ st.set_page_config(
     layout="wide",
 )
 
+# ----------------------------------------------------------------------
+# 성능 계측
+# ----------------------------------------------------------------------
+# 계측 기록을 보관하는 기간(초)과 분류별 최대 건수
+METRICS_WINDOW = 60 * 60
+METRICS_MAX_RECORDS = 20000
+# 외부 API 호출로 세는 분류. 'app'은 앱 내부 처리 시간입니다.
+API_CATEGORIES = ("sheets", "docs", "gemini")
+
+def percentile(values, q):
+    """정렬된 값 목록의 q 분위수(최근접 순위 방식)."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+class MetricsRegistry:
+    """시트, 문서, Gemini 호출과 주요 함수의 실행 시간을 모으는 메모리 기록부입니다.
+
+    기록은 {'time', 'category', 'name', 'seconds', 'ok', 'run_id', ...} 형태의 dict이며
+    최근 METRICS_WINDOW초 분량만 남깁니다. 분류마다 따로 max_records건까지 보관하므로
+    자주 생기는 'app' 기록이 외부 API 호출 기록을 밀어내지 않습니다. run_id는
+    begin_run()을 호출한 스레드(스크립트 rerun)에서만 채워지고, 백그라운드 작업의
+    기록은 None입니다.
+    """
+
+    def __init__(self, window=METRICS_WINDOW, max_records=METRICS_MAX_RECORDS):
+        self.window = window
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._records = {}  # 분류 -> deque
+        self._evicted_at = {}  # 분류 -> 한도 때문에 마지막으로 지운 기록의 시각
+        self._runs = deque(maxlen=max_records)
+
+    def begin_run(self):
+        """rerun 시작을 기록하고, 이 스레드에서 생기는 기록에 붙일 ID를 정합니다."""
+        self._local.run_id = uuid.uuid4().hex
+        with self._lock:
+            if len(self._runs) == self._runs.maxlen:
+                self._evicted_at['rerun'] = self._runs[0]
+            self._runs.append(time.time())
+
+    def record(self, category, name, seconds, ok=True, **fields):
+        entry = {'time': time.time(), 'category': category, 'name': name, 'seconds': seconds, 'ok': ok,
+                 'run_id': getattr(self._local, 'run_id', None), **fields}
+        with self._lock:
+            records = self._records.setdefault(category, deque(maxlen=self.max_records))
+            if len(records) == records.maxlen:
+                self._evicted_at[category] = records[0]['time']
+            records.append(entry)
+
+    @contextmanager
+    def timed(self, category, name, **fields):
+        """블록의 실행 시간을 기록합니다. 넘겨받은 dict에 토큰 수 등을 덧붙일 수 있습니다."""
+        started = time.perf_counter()
+        ok = False
+        try:
+            yield fields
+            ok = True
+        finally:
+            self.record(category, name, time.perf_counter() - started, ok, **fields)
+
+    def records(self, window=None):
+        since = time.time() - (window or self.window)
+        with self._lock:
+            entries = [entry for records in self._records.values() for entry in records if entry['time'] >= since]
+        return sorted(entries, key=lambda entry: entry['time'])
+
+    def truncated(self, window=None):
+        """보관 한도에 걸려 기간 안의 기록이 일부 지워진 분류 목록."""
+        since = time.time() - (window or self.window)
+        with self._lock:
+            return sorted(category for category, evicted_at in self._evicted_at.items() if evicted_at >= since)
+
+    def latency_summary(self, window=None):
+        """(분류, 이름)별 호출 수, 실패 수, p50/p95/최대 지연 시간(초)."""
+        grouped = {}
+        for entry in self.records(window):
+            grouped.setdefault((entry['category'], entry['name']), []).append(entry)
+        summary = {}
+        for key, entries in sorted(grouped.items()):
+            seconds = sorted(entry['seconds'] for entry in entries)
+            summary[key] = {
+                'count': len(entries),
+                'errors': sum(1 for entry in entries if not entry['ok']),
+                'p50': percentile(seconds, 0.5),
+                'p95': percentile(seconds, 0.95),
+                'max': seconds[-1],
+            }
+        return summary
+
+    def calls_per_run(self, window=None):
+        """rerun 수와 rerun 한 번당 외부 API 호출 수의 평균, 최대."""
+        since = time.time() - (window or self.window)
+        with self._lock:
+            runs = sum(1 for started in self._runs if started >= since)
+        per_run = {}
+        for entry in self.records(window):
+            if entry['run_id'] is not None and entry['category'] in API_CATEGORIES:
+                per_run[entry['run_id']] = per_run.get(entry['run_id'], 0) + 1
+        total = sum(per_run.values())
+        return {'runs': runs, 'average': total / runs if runs else 0.0, 'max': max(per_run.values(), default=0)}
+
+    def quota_usage(self, window=None):
+        """외부 API별 최근 1분/기간 전체 호출 수와 Gemini 토큰 사용량."""
+        now = time.time()
+        usage = {category: {'last_minute': 0, 'window': 0, 'prompt_tokens': 0, 'output_tokens': 0}
+                 for category in API_CATEGORIES}
+        for entry in self.records(window):
+            if entry['category'] not in usage:
+                continue
+            counts = usage[entry['category']]
+            counts['window'] += 1
+            if now - entry['time'] <= 60:
+                counts['last_minute'] += 1
+            counts['prompt_tokens'] += entry.get('prompt_tokens') or 0
+            counts['output_tokens'] += entry.get('output_tokens') or 0
+        return usage
+
+    def export_jsonl(self, window=None):
+        """기록을 한 줄에 하나씩 JSON으로 내보냅니다."""
+        return "\n".join(json.dumps(entry, ensure_ascii=False) for entry in self.records(window))
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    return MetricsRegistry()
+
+def instrumented(category, name=None):
+    """함수 호출 시간을 get_metrics()에 기록하는 데코레이터."""
+    def decorator(func):
+        label = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timed(category, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 # ----------------------------------------------------------------------
 # API 연결 및 인증
 # ----------------------------------------------------------------------
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/documents.readonly"
+]
+GEMINI_MODEL_NAME = 'gemini-1.0-pro'
+# 토큰 만료 여부를 확인하는 주기(초)와, 만료 전에 미리 갱신할 여유 시간
+CONNECTION_CHECK_INTERVAL = 60
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+def load_credentials():
+    """Streamlit Secrets에서 서비스 계정 인증 정보를 만듭니다."""
+    account = st.secrets["gcp_service_account"]
+    creds_json = {
+        "type": account["type"],
+        "project_id": account["project_id"],
+        "private_key_id": account["private_key_id"],
+        "private_key": account["private_key"].replace('\\n', '\n'),
+        "client_email": account["client_email"],
+        "client_id": account["client_id"],
+        "auth_uri": account["auth_uri"],
+        "token_uri": account["token_uri"],
+        "auth_provider_x509_cert_url": account["auth_provider_x509_cert_url"],
+        "client_x509_cert_url": account["client_x509_cert_url"]
+    }
+    return Credentials.from_service_account_info(creds_json, scopes=SCOPES)
+
+class ConnectionPool:
+    """프로세스 전체에서 공유하는 Google Sheets, Docs, Gemini 연결입니다.
+
+    모든 세션이 같은 인스턴스를 사용하므로 인증과 클라이언트 생성은 프로세스당 한 번만
+    일어납니다. 토큰은 만료 전에 미리 갱신하고, 갱신에 실패하면 연결을 다시 만듭니다.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.creds = None
+        self.gs = None
+        self.docs_service = None
+        self.model = None
+        self.last_checked = 0.0
+
+    def connect(self):
+        with self._lock:
+            creds = load_credentials()
+            gs = gspread.authorize(creds)
+            docs_service = googleapiclient.discovery.build('docs', 'v1', credentials=creds, cache_discovery=False)
+            genai.configure(api_key=st.secrets["gemini_api_key"]["api_key"])
+            # [수정] 안정적인 모델 이름과 JSON 출력을 위한 설정 추가
+            generation_config = {"response_mime_type": "application/json"}
+            model = genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=generation_config)
+            self.creds, self.gs, self.docs_service, self.model = creds, gs, docs_service, model
+            self.last_checked = time.monotonic()
+
+    def reconnect(self):
+        """기존 연결을 버리고 새로 만듭니다. API 인증 오류 이후에 호출합니다."""
+        with self._lock:
+            self.gs = self.docs_service = self.model = None
+            self.connect()
+
+    def check_health(self):
+        """토큰이 만료되었거나 곧 만료되면 갱신하고, 실패하면 다시 연결합니다."""
+        with self._lock:
+            expiry = self.creds.expiry
+            expiring = expiry is None or expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN
+            if not self.creds.valid or expiring:
+                try:
+                    self.creds.refresh(google.auth.transport.requests.Request())
+                except Exception:
+                    self.reconnect()
+            self.last_checked = time.monotonic()
+
+    def get(self):
+        with self._lock:
+            if self.gs is None:
+                self.connect()
+            elif time.monotonic() - self.last_checked > CONNECTION_CHECK_INTERVAL:
+                self.check_health()
+            return self.gs, self.docs_service, self.model
+
+@st.cache_resource(show_spinner=False)
+def get_connection_pool():
+    return ConnectionPool()
+
+@st.cache_resource(show_spinner=False)
+def warm_start():
+    """서버 프로세스가 처음 스크립트를 실행할 때 한 번만 연결을 미리 만들어 둡니다.
+
+    연결에 실패하면 예외를 그대로 올립니다. cache_resource는 예외를 캐시하지 않으므로
+    다음 rerun에서 다시 시도하고, 성공한 뒤에야 템플릿을 미리 받기 시작합니다.
+    """
+    _, docs_service, _ = get_connection_pool().get()
+    # 템플릿은 로그인 화면에 필요하지 않으므로 백그라운드에서 미리 받아 둡니다.
+    threading.Thread(
+        target=get_template_cache().prefetch,
+        args=(docs_service, CLASS_LIST.values()),
+        daemon=True,
+    ).start()
+    return time.time()
+
+@instrumented("app")
 def setup_connections():
     """Google Sheets, Docs, Gemini API에 연결합니다."""
+    pool = get_connection_pool()
     try:
-        creds_json = {
-            "type": st.secrets["gcp_service_account"]["type"],
-            "project_id": st.secrets["gcp_service_account"]["project_id"],
-            "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-            "private_key": st.secrets["gcp_service_account"]["private_key"].replace('\\n', '\n'),
-            "client_email": st.secrets["gcp_service_account"]["client_email"],
-            "client_id": st.secrets["gcp_service_account"]["client_id"],
-            "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-            "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"]
-        }
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-            "https://www.googleapis.com/auth/documents.readonly"
-        ]
-        creds = Credentials.from_service_account_info(creds_json, scopes=scopes)
-        gs = gspread.authorize(creds)
-        docs_service = googleapiclient.discovery.build('docs', 'v1', credentials=creds)
-        genai.configure(api_key=st.secrets["gemini_api_key"]["api_key"])
-        # [수정] 안정적인 모델 이름과 JSON 출력을 위한 설정 추가
-        generation_config = {"response_mime_type": "application/json"}
-        model = genai.GenerativeModel('gemini-1.0-pro', generation_config=generation_config)
-        return gs, docs_service, model
+        try:
+            return pool.get()
+        except Exception:
+            pool.reconnect()
+            return pool.get()
     except Exception as e:
         st.error(f"API 연결 중 오류가 발생했습니다: {e}")
         st.info("Streamlit Secrets 설정을 확인해주세요.")
         return None, None, None
 
+# 탭 이름별 필수 열. 없는 탭이나 열은 bootstrap_sheets가 프로세스당 한 번 만들어 둡니다.
+SHEET_SCHEMAS = {
+    "users": ["student_id", "password", "password_changed"],
+    "submissions": ["student_id", "class_name", "timestamp", "submission_content", "feedback", "record_suggestion",
+                    "activity_feedback"],
+    "assessments": ["student_id", "class_name", "timestamp", "content_hash", "assessment"],
+}
+
+@st.cache_resource(show_spinner=False)
+@instrumented("sheets")
+def bootstrap_sheets(_gs_client, sheet_key):
+    """스프레드시트를 한 번만 열어 필요한 탭과 열을 만들고 워크시트 핸들을 반환합니다.
+
+    결과는 스프레드시트 Key별로 캐시되므로 이후의 rerun에서는 API를 호출하지 않습니다.
+    """
+    spreadsheet = _gs_client.open_by_key(sheet_key)
+    existing = {worksheet.title: worksheet for worksheet in spreadsheet.worksheets()}
+    worksheets = {}
+    for sheet_name, required in SHEET_SCHEMAS.items():
+        worksheet = existing.get(sheet_name)
+        if worksheet is None:
+            worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="100", cols="20")
+            worksheet.append_row(required)
+        else:
+            headers = worksheet.row_values(1)
+            missing = [header for header in required if header not in headers]
+            if missing:
+                if worksheet.col_count < len(headers) + len(missing):
+                    worksheet.add_cols(len(headers) + len(missing) - worksheet.col_count)
+                start = gspread.utils.rowcol_to_a1(1, len(headers) + 1)
+                end = gspread.utils.rowcol_to_a1(1, len(headers) + len(missing))
+                worksheet.update(range_name=f"{start}:{end}", values=[missing])
+        worksheets[sheet_name] = worksheet
+    return worksheets
+
+@instrumented("app")
 def get_sheet(gs_client, sheet_name):
-    """지정된 이름의 구글 시트를 가져오고, 필요한 열이 없으면 추가합니다."""
+    """지정된 이름의 구글 시트를 가져옵니다. 탭과 열 준비는 bootstrap_sheets에서 한 번만 합니다."""
     try:
-        spreadsheet = gs_client.open_by_key(st.secrets["google_sheet_key"]["sheet_key"])
+        return bootstrap_sheets(gs_client, st.secrets["google_sheet_key"]["sheet_key"])[sheet_name]
     except gspread.exceptions.SpreadsheetNotFound:
         st.error("지정된 Key의 구글 스프레드시트를 찾을 수 없습니다.")
         return None
+
+# ----------------------------------------------------------------------
+# 시트 데이터 캐시
+# ----------------------------------------------------------------------
+# 이 시간(초)이 지나면 백그라운드에서 시트를 다시 읽어 직접 수정된 내용을 반영합니다.
+SHEET_CACHE_TTL = 60
+# 여러 세션의 쓰기를 모아 시트에 보내는 주기(초). flush마다 키 열을 한 번 읽으므로
+# 너무 짧으면 읽기 할당량을 많이 씁니다.
+WRITE_FLUSH_INTERVAL = 5
+# 시트 쓰기가 연달아 이 횟수만큼 실패하면 자동 재시도를 멈추고 교사 화면에 알립니다.
+WRITE_MAX_RETRIES = 5
+# 다시 읽기에 실패했거나 결과를 쓸 수 없었을 때 다음 시도까지 기다리는 시간(초)
+RELOAD_RETRY_DELAY = 10
+
+class SheetStore:
+    """구글 시트 한 장의 내용을 메모리에 보관하는 write-through 캐시입니다.
+
+    처음 한 번만 시트 전체를 읽고, 앱에서 추가/수정한 행은 캐시에 즉시 반영한 뒤
+    WRITE_FLUSH_INTERVAL마다 모아서 시트에 보냅니다. 수정을 보내기 전에는 키 열을 읽어
+    대상 행이 아직 같은 학생의 행인지 확인합니다. 시트에서 직접 고친 내용은 TTL이
+    지난 뒤 백그라운드 스레드가 다시 읽어 가져옵니다. 다시 읽는 동안 앱에서 쓴 내용은
+    key_columns로 새로 읽은 행을 찾아 다시 반영합니다. 내용이 바뀔 때마다 version이
+    올라가므로 파생 데이터는 이 값으로 무효화 여부를 판단합니다.
+    """
+
+    # 행을 구별하는 열. 하위 클래스에서 정합니다.
+    key_columns = ()
+
+    def __init__(self, worksheet, ttl=SHEET_CACHE_TTL):
+        self.worksheet = worksheet
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._journal = None  # 다시 읽는 동안 앱에서 쓴 내용 [(키, 바뀐 값, 행)]
+        self._refreshing = False
+        self._pending_appends = []
+        self._pending_updates = {}  # 키 -> {'row_number', 'row', 'changes'}
+        self._flush_timer = None
+        self._flush_failures = 0
+        self.flush_error = None
+        self.headers = []
+        self.columns = {}  # 열 이름 -> 열 번호(1부터)
+        self.rows = []  # rows[i]는 시트의 i + 2번째 행입니다.
+        self.version = 0
+        self.loaded_at = 0.0
+        self.load()
+        atexit.register(self.flush)
+
+    def _key(self, row):
+        return tuple(str(row.get(col, '')) for col in self.key_columns)
+
+    def _journal_write(self, changes, row):
+        if self._journal is not None:
+            self._journal.append((self._key(row), dict(changes), row))
+
+    def _merge(self, rows, positions, entry):
+        """다시 읽는 동안 앱에서 쓴 내용 하나를 새로 읽은 행에 반영하고 그 행 번호를 반환합니다."""
+        key, changes, row = entry
+        row_number = positions.get(key)
+        if row_number is None:
+            rows.append(dict(row))
+            row_number = positions[key] = len(rows) + 1
+        else:
+            rows[row_number - 2].update(changes)
+        return row_number
+
+    def _retry_later(self):
+        """RELOAD_RETRY_DELAY 뒤에 다시 읽도록 loaded_at을 조정합니다."""
+        self.loaded_at = time.monotonic() - self.ttl + RELOAD_RETRY_DELAY
+
+    def load(self):
+        """시트 전체를 다시 읽습니다.
+
+        색인은 잠금 밖에서 새로 만들어 두고, 잠금 안에서는 읽는 도중 앱에서 쓴 행만
+        반영한 뒤 바꿔 끼웁니다. 그래서 행이 많아도 다른 세션의 조회를 오래 막지 않습니다.
+        키가 없는 시트는 도중에 쓴 내용이 있으면 결과를 버리고 RELOAD_RETRY_DELAY 뒤에
+        다시 시도합니다. 아직 보내지 못한 쓰기가 있으면 새로 읽은 행에는 그 내용이 없으므로
+        읽지 않고 현재 행을 유지한 채 RELOAD_RETRY_DELAY 뒤에 다시 시도합니다.
+        """
+        with self._lock:
+            self._journal = []
+        try:
+            if not self.flush():
+                with self._lock:
+                    self._retry_later()
+                return False
+            with get_metrics().timed("sheets", "get_all_values", sheet=self.worksheet.title) as fields:
+                values = self.worksheet.get_all_values()
+                fields['rows'] = len(values)
+            headers = values[0] if values else []
+            rows = [dict(zip(headers, row + [''] * (len(headers) - len(row)))) for row in values[1:]]
+            positions = {self._key(row): row_number for row_number, row in enumerate(rows, start=2)}
+            index = self._build_indexes(rows)
+            with self._lock:
+                if self._journal and not self.key_columns:
+                    self._retry_later()
+                    return False
+                for entry in self._journal:
+                    self._index_row(index, rows, self._merge(rows, positions, entry))
+                for key, pending in self._pending_updates.items():
+                    if key in positions:
+                        pending['row_number'] = positions[key]
+                self.headers, self.rows = headers, rows
+                self.columns = {header: col for col, header in enumerate(headers, start=1)}
+                vars(self).update(vars(index))
+                self.version += 1
+                self.loaded_at = time.monotonic()
+            return True
+        finally:
+            with self._lock:
+                self._journal = None
+
+    def _background_refresh(self):
+        try:
+            self.load()
+        except Exception:
+            with self._lock:
+                self._retry_later()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def maybe_refresh(self):
+        """TTL이 지났으면 현재 데이터를 그대로 쓰면서 백그라운드에서 새로 읽습니다."""
+        with self._lock:
+            if self._refreshing or time.monotonic() - self.loaded_at < self.ttl:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def invalidate(self):
+        """다음 조회 때 시트를 다시 읽도록 합니다."""
+        with self._lock:
+            self.loaded_at = 0.0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def records(self):
+        self.maybe_refresh()
+        with self._lock:
+            return list(self.rows)
+
+    def _new_indexes(self):
+        """빈 색인을 {속성 이름: 값}으로 반환합니다. 하위 클래스에서 구현합니다."""
+        return {}
+
+    def _build_indexes(self, rows):
+        """rows 전체로 새 색인을 만듭니다. 잠금 밖에서 호출하므로 현재 색인은 건드리지 않습니다."""
+        index = SimpleNamespace(**self._new_indexes())
+        for row_number in range(2, len(rows) + 2):
+            self._index_row(index, rows, row_number)
+        return index
+
+    def _index_row(self, index, rows, row_number):
+        """한 행이 추가되거나 수정되었을 때 index를 갱신합니다. 하위 클래스에서 구현합니다.
+
+        index는 현재 색인을 가진 self이거나 _build_indexes가 새로 만드는 색인입니다.
+        """
+
+    def _changed(self):
+        self.version += 1
+
+    def _schedule_flush(self):
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(WRITE_FLUSH_INTERVAL, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def append(self, record):
+        values = [record.get(header, "") for header in self.headers]
+        with self._lock:
+            self.rows.append({header: str(value) for header, value in zip(self.headers, values)})
+            row_number = len(self.rows) + 1
+            self._pending_appends.append(values)
+            self._journal_write(self.rows[-1], self.rows[-1])
+            self._index_row(self, self.rows, row_number)
+            self._changed()
+            self._schedule_flush()
+            return row_number
+
+    def update(self, row_number, changes):
+        unknown = set(changes) - set(self.columns)
+        if unknown:
+            raise KeyError(f"시트에 없는 열입니다: {', '.join(sorted(unknown))}")
+        with self._lock:
+            row = self.rows[row_number - 2]
+            changes = {key: str(value) for key, value in changes.items()}
+            row.update(changes)
+            pending_key = self._key(row) if self.key_columns else (row_number,)
+            pending = self._pending_updates.setdefault(pending_key, {'changes': {}})
+            pending.update(row_number=row_number, row=row)
+            pending['changes'].update(changes)
+            self._journal_write(changes, row)
+            self._index_row(self, self.rows, row_number)
+            self._changed()
+            self._schedule_flush()
+
+    def _row_ranges(self, row_number, changes):
+        """한 행의 변경 내용을 연속된 열끼리 묶어 batch_update용 범위로 만듭니다."""
+        columns = sorted(self.columns[key] for key in changes)
+        ranges, run = [], [columns[0]]
+        for col in columns[1:]:
+            if col != run[-1] + 1:
+                ranges.append(run)
+                run = []
+            run.append(col)
+        ranges.append(run)
+        return [{
+            'range': f"{gspread.utils.rowcol_to_a1(row_number, run[0])}:{gspread.utils.rowcol_to_a1(row_number, run[-1])}",
+            'values': [[changes[self.headers[col - 1]] for col in run]],
+        } for run in ranges]
+
+    def _sheet_keys(self):
+        """시트의 키 열만 읽어 {행 번호: 키}를 만듭니다."""
+        letters = [gspread.utils.rowcol_to_a1(1, self.columns[col])[:-1] for col in self.key_columns]
+        with get_metrics().timed("sheets", "batch_get", sheet=self.worksheet.title):
+            columns = self.worksheet.batch_get([f"{letter}:{letter}" for letter in letters])
+        length = max((len(column) for column in columns), default=0)
+        return {
+            index + 1: tuple(str(column[index][0]) if index < len(column) and column[index] else ''
+                             for column in columns)
+            for index in range(1, length)
+        }
+
+    def _resolve_updates(self, updates):
+        """수정할 행이 아직 같은 키인지 확인해 batch_update 범위와 새로 추가할 행을 만듭니다.
+
+        교사가 시트에서 행을 지우거나 끼워 넣거나 정렬했으면 키로 현재 위치를 다시 찾고,
+        행이 없어졌으면 새 행으로 추가합니다. 위치가 바뀐 것이 보이면 다음 조회 때 다시 읽습니다.
+        """
+        if not self.key_columns or any(col not in self.columns for col in self.key_columns):
+            return [item for pending in updates.values()
+                    for item in self._row_ranges(pending['row_number'], pending['changes'])], []
+        sheet_keys = self._sheet_keys()
+        positions = {key: row_number for row_number, key in sheet_keys.items()}
+        data, missing, moved = [], [], False
+        for key, pending in updates.items():
+            row_number = pending['row_number']
+            if sheet_keys.get(row_number) != key:
+                moved = True
+                row_number = positions.get(key)
+            if row_number is None:
+                missing.append([pending['row'].get(header, '') for header in self.headers])
+            else:
+                data.extend(self._row_ranges(row_number, pending['changes']))
+        if moved:
+            self.invalidate()
+        return data, missing
+
+    def flush(self):
+        """쌓여 있는 추가/수정을 시트에 보냅니다.
+
+        실패하면 다음 주기에 다시 시도하고, WRITE_MAX_RETRIES번 연달아 실패하면 새 쓰기가
+        생길 때까지 멈춥니다. 상태는 write_status()로 확인합니다.
+        """
+        with self._flush_lock:
+            with self._lock:
+                appends, self._pending_appends = self._pending_appends, []
+                updates, self._pending_updates = self._pending_updates, {}
+                self._flush_timer = None
+            try:
+                if appends:
+                    with get_metrics().timed("sheets", "append_rows", sheet=self.worksheet.title, rows=len(appends)):
+                        self.worksheet.append_rows(appends)
+                    appends = []
+                if updates:
+                    data, missing = self._resolve_updates(updates)
+                    if data:
+                        with get_metrics().timed("sheets", "batch_update", sheet=self.worksheet.title, ranges=len(data)):
+                            self.worksheet.batch_update(data)
+                    if missing:
+                        with get_metrics().timed("sheets", "append_rows", sheet=self.worksheet.title, rows=len(missing)):
+                            self.worksheet.append_rows(missing)
+                with self._lock:
+                    self._flush_failures = 0
+                    self.flush_error = None
+                return True
+            except Exception as e:
+                with self._lock:
+                    self._pending_appends[:0] = appends
+                    for key, pending in updates.items():
+                        newer = self._pending_updates.get(key)
+                        if newer is not None:
+                            pending = {**newer, 'changes': {**pending['changes'], **newer['changes']}}
+                        self._pending_updates[key] = pending
+                    self._flush_failures += 1
+                    self.flush_error = str(e) or repr(e)
+                    if self._flush_failures < WRITE_MAX_RETRIES:
+                        self._schedule_flush()
+                return False
+
+    def write_status(self):
+        """아직 보내지 못한 쓰기 수와 마지막 오류. 자동 재시도를 멈췄으면 stalled가 True."""
+        with self._lock:
+            return {
+                'sheet': self.worksheet.title,
+                'pending': len(self._pending_appends) + len(self._pending_updates),
+                'failures': self._flush_failures,
+                'error': self.flush_error,
+                'stalled': self._flush_failures >= WRITE_MAX_RETRIES,
+            }
+
+class SubmissionAggregates:
+    """수업별 제출 통계를 바뀐 행만으로 갱신합니다.
+
+    (student_id, class_name)마다 마지막으로 반영한 기여분을 기억해 두었다가, 제출이
+    바뀌면 이전 기여분을 빼고 새 기여분을 더합니다. 제출 내용 JSON은 행이 바뀔 때 한
+    번만 파싱하므로 대시보드를 다시 그릴 때는 전체 행을 다시 읽지 않습니다. 시트를
+    다시 읽어 새로 만들 때는 previous에서 내용이 같은 행의 기여분을 그대로 가져옵니다.
+    """
+
+    def __init__(self, previous=None):
+        self._lock = threading.Lock()
+        self._contributions = {}
+        self._classes = {}
+        self._previous = previous
+
+    @staticmethod
+    def _source(row):
+        return (row.get('timestamp', ''), hash(row.get('submission_content') or ''))
+
+    def _reusable(self, key, source):
+        """previous에 내용이 같은 행의 기여분이 있으면 반환합니다."""
+        if self._previous is None:
+            return None
+        with self._previous._lock:
+            contribution = self._previous._contributions.get(key)
+        return contribution if contribution is not None and contribution['source'] == source else None
+
+    def _contribution(self, key, row):
+        source = self._source(row)
+        reusable = self._reusable(key, source)
+        if reusable is not None:
+            return reusable
+        try:
+            content = json.loads(row.get('submission_content') or '{}')
+        except json.JSONDecodeError:
+            content = {}
+        if not isinstance(content, dict):
+            content = {}
+        lengths = {label: len(value.strip()) for label, value in content.items()
+                   if isinstance(value, str) and value.strip()}
+        return {'lengths': lengths, 'timestamp': row.get('timestamp', ''), 'source': source}
+
+    @staticmethod
+    def _add(stats, contribution, sign):
+        for label, length in contribution['lengths'].items():
+            stats['label_counts'][label] = stats['label_counts'].get(label, 0) + sign
+            stats['total_length'] += sign * length
+            stats['responses'] += sign
+
+    def detach(self):
+        """다시 만들기가 끝났으면 previous를 놓아 이전 통계가 메모리에 남지 않게 합니다."""
+        self._previous = None
+
+    def apply(self, row):
+        """한 학생의 최신 제출 행을 반영합니다."""
+        student_id, class_name = str(row.get('student_id', '')), row.get('class_name', '')
+        contribution = self._contribution((student_id, class_name), row)
+        with self._lock:
+            stats = self._classes.setdefault(class_name, {
+                'label_counts': {}, 'total_length': 0, 'responses': 0, 'last_activity': {},
+            })
+            previous = self._contributions.get((student_id, class_name))
+            if previous is not None:
+                self._add(stats, previous, -1)
+            self._add(stats, contribution, 1)
+            self._contributions[(student_id, class_name)] = contribution
+            stats['last_activity'][student_id] = contribution['timestamp']
+
+    def summary(self, class_name):
+        """수업 통계의 복사본을 반환합니다. 제출이 없으면 None."""
+        with self._lock:
+            stats = self._classes.get(class_name)
+            if stats is None:
+                return None
+            last_activity = dict(stats['last_activity'])
+            return {
+                'submissions': len(last_activity),
+                'label_counts': {label: count for label, count in stats['label_counts'].items() if count > 0},
+                'average_length': stats['total_length'] / stats['responses'] if stats['responses'] else 0,
+                'last_activity': last_activity,
+                'last_timestamp': max(last_activity.values(), default=''),
+            }
+
+class UsersStore(SheetStore):
+    """users 시트. student_id로 행을 바로 찾습니다."""
+
+    key_columns = ("student_id",)
+
+    def _new_indexes(self):
+        return {'by_student_id': {}}
+
+    def _index_row(self, index, rows, row_number):
+        index.by_student_id[rows[row_number - 2].get('student_id', '')] = row_number
+
+    def get_user(self, student_id):
+        """student_id의 행을 반환합니다. 없으면 None."""
+        self.maybe_refresh()
+        with self._lock:
+            row_number = self.by_student_id.get(str(student_id))
+            return self.rows[row_number - 2] if row_number is not None else None
+
+    def student_ids(self):
+        self.maybe_refresh()
+        with self._lock:
+            return [student_id for student_id in self.by_student_id if student_id]
+
+    def update_password(self, student_id, new_password):
+        """비밀번호를 바꾸고 변경 완료로 표시합니다. 학생이 없으면 False."""
+        with self._lock:
+            row_number = self.by_student_id.get(str(student_id))
+            if row_number is None:
+                return False
+            self.update(row_number, {'password': new_password, 'password_changed': 'TRUE'})
+            return True
+
+class SubmissionsStore(SheetStore):
+    """submissions 시트. (student_id, class_name)별 최신 행과 수업별 학생 목록을 색인합니다."""
+
+    key_columns = ("student_id", "class_name")
+
+    def _new_indexes(self):
+        return {
+            'latest': {},
+            'students_by_class': {},
+            'aggregates': SubmissionAggregates(previous=getattr(self, 'aggregates', None)),
+        }
+
+    def _build_indexes(self, rows):
+        index = super()._build_indexes(rows)
+        index.aggregates.detach()
+        return index
+
+    def _index_row(self, index, rows, row_number):
+        row = rows[row_number - 2]
+        student_id, class_name = row.get('student_id', ''), row.get('class_name', '')
+        key = (student_id, class_name)
+        current = index.latest.get(key)
+        if current is None or current == row_number or rows[current - 2].get('timestamp', '') <= row.get('timestamp', ''):
+            index.latest[key] = row_number
+            index.aggregates.apply(row)
+        index.students_by_class.setdefault(class_name, {})[student_id] = None
+
+    def latest_submission(self, student_id, class_name):
+        """가장 최근 제출 행을 반환합니다. 제출 기록이 없으면 None."""
+        self.maybe_refresh()
+        with self._lock:
+            row_number = self.latest.get((str(student_id), class_name))
+            return self.rows[row_number - 2] if row_number is not None else None
+
+    def upsert(self, student_id, class_name, fields):
+        """기존 제출 행이 있으면 고치고, 없으면 새 행을 추가합니다."""
+        with self._lock:
+            row_number = self.latest.get((str(student_id), class_name))
+            if row_number is not None:
+                self.update(row_number, fields)
+            else:
+                self.append({'student_id': student_id, 'class_name': class_name, **fields})
+
+    def class_names(self):
+        self.maybe_refresh()
+        with self._lock:
+            return list(self.students_by_class)
+
+    def students_in_class(self, class_name):
+        self.maybe_refresh()
+        with self._lock:
+            return list(self.students_by_class.get(class_name, {}))
+
+    def class_summary(self, class_name):
+        self.maybe_refresh()
+        return self.aggregates.summary(class_name)
+
+class AssessmentsStore(SheetStore):
+    """assessments 시트. (student_id, class_name)별 종합 평가 의견 행을 색인합니다."""
+
+    key_columns = ("student_id", "class_name")
+
+    def _new_indexes(self):
+        return {'by_key': {}}
+
+    def _index_row(self, index, rows, row_number):
+        row = rows[row_number - 2]
+        index.by_key[(row.get('student_id', ''), row.get('class_name', ''))] = row_number
+
+    def get_assessment(self, student_id, class_name):
+        """저장된 평가 행을 반환합니다. 없으면 None."""
+        self.maybe_refresh()
+        with self._lock:
+            row_number = self.by_key.get((str(student_id), class_name))
+            return self.rows[row_number - 2] if row_number is not None else None
+
+    def save_assessment(self, student_id, class_name, content_hash, assessment):
+        record = {
+            'timestamp': current_timestamp(),
+            'content_hash': content_hash,
+            'assessment': assessment,
+        }
+        with self._lock:
+            row_number = self.by_key.get((str(student_id), class_name))
+            if row_number is not None:
+                self.update(row_number, record)
+            else:
+                self.append({'student_id': student_id, 'class_name': class_name, **record})
+
+STORE_CLASSES = {"users": UsersStore, "submissions": SubmissionsStore, "assessments": AssessmentsStore}
+
+@st.cache_resource(show_spinner=False)
+def get_sheet_store(sheet_name, _worksheet):
+    """시트 이름별로 프로세스 전체에서 하나의 SheetStore를 공유합니다."""
+    return STORE_CLASSES.get(sheet_name, SheetStore)(_worksheet)
+
+def sheet_write_status(store):
+    """저장소가 쓰는 시트의 write_status(). 시트를 쓰지 않는 저장소면 None."""
+    sheet_store = getattr(store, 'mirror', store)
+    write_status = getattr(sheet_store, 'write_status', None)
+    return write_status() if write_status is not None else None
+
+def current_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# ----------------------------------------------------------------------
+# 저장소 백엔드
+# ----------------------------------------------------------------------
+# Secrets의 [storage] backend 값으로 선택합니다.
+#   "sheets"        : 구글 시트만 사용 (기본값)
+#   "sqlite"        : 로컬 SQLite만 사용
+#   "sqlite+sheets" : SQLite를 기본 저장소로 쓰고 구글 시트에 비동기로 복제
+STORAGE_BACKENDS = ("sheets", "sqlite", "sqlite+sheets")
+# 기본 SQLite 파일은 app.py 옆에 만듭니다. Streamlit Community Cloud처럼 재배포할 때
+# 작업 폴더를 새로 만드는 곳에서는 이 파일이 사라지므로 sqlite_path를 영구 디스크로 바꾸거나
+# "sqlite+sheets"를 쓰세요.
+DEFAULT_SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feedback.sqlite3")
+
+class Storage:
+    """users, submissions, assessments 저장소 묶음입니다.
+
+    어느 백엔드든 세 저장소는 같은 메서드를 제공합니다.
+    users: get_user, student_ids, update_password, len()
+    submissions: latest_submission, upsert, class_names, students_in_class, class_summary
+    assessments: get_assessment, save_assessment
+    """
+
+    def __init__(self, backend, users, submissions, assessments):
+        self.backend = backend
+        self.users = users
+        self.submissions = submissions
+        self.assessments = assessments
+
+class SQLiteDatabase:
+    """스레드 사이에서 공유하는 SQLite 연결입니다. 모든 쿼리는 잠금 안에서 실행합니다."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        student_id TEXT PRIMARY KEY,
+        password TEXT NOT NULL DEFAULT '',
+        password_changed TEXT NOT NULL DEFAULT ''
+    );
+    CREATE TABLE IF NOT EXISTS submissions (
+        student_id TEXT NOT NULL,
+        class_name TEXT NOT NULL,
+        timestamp TEXT NOT NULL DEFAULT '',
+        submission_content TEXT NOT NULL DEFAULT '',
+        feedback TEXT NOT NULL DEFAULT '',
+        record_suggestion TEXT NOT NULL DEFAULT '',
+        activity_feedback TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (student_id, class_name)
+    );
+    CREATE INDEX IF NOT EXISTS submissions_by_class ON submissions (class_name);
+    CREATE TABLE IF NOT EXISTS assessments (
+        student_id TEXT NOT NULL,
+        class_name TEXT NOT NULL,
+        timestamp TEXT NOT NULL DEFAULT '',
+        content_hash TEXT NOT NULL DEFAULT '',
+        assessment TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY (student_id, class_name)
+    );
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._add_missing_columns()
+
+    def _add_missing_columns(self):
+        """이전 버전에서 만든 DB에 새로 생긴 열을 추가합니다."""
+        for table, columns in SHEET_SCHEMAS.items():
+            existing = {row['name'] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column in columns:
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        self._conn.commit()
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def execute(self, sql, params=()):
+        """한 트랜잭션으로 실행합니다."""
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(sql, rows)
+
+class SQLiteTable:
+    """SQLite 테이블 하나. import_rows로 시트의 행을 한꺼번에 가져올 수 있습니다."""
+
+    table = None
+    columns = ()
+    key_columns = ()
+
+    # SQLite는 앱을 거쳐서만 바뀌므로 version이 고정되어 있고 다시 읽을 필요도 없습니다.
+    version = 0
+
+    def __init__(self, db):
+        self.db = db
+
+    def maybe_refresh(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+    def __len__(self):
+        return self.db.query(f"SELECT COUNT(*) AS n FROM {self.table}")[0]['n']
+
+    def records(self):
+        return self.db.query(f"SELECT {', '.join(self.columns)} FROM {self.table} ORDER BY rowid")
+
+    def _upsert_sql(self, columns=None, overwrite=True):
+        """키가 겹치면 columns에 있는 열만 고치는 INSERT 문을 만듭니다."""
+        columns = columns or self.columns
+        placeholders = ', '.join('?' for _ in columns)
+        sql = f"INSERT INTO {self.table} ({', '.join(columns)}) VALUES ({placeholders}) ON CONFLICT ({', '.join(self.key_columns)}) DO "
+        updates = ', '.join(f"{col} = excluded.{col}" for col in columns if col not in self.key_columns)
+        if not overwrite or not updates:
+            return sql + "NOTHING"
+        return sql + f"UPDATE SET {updates}"
+
+    def import_rows(self, rows, overwrite=False):
+        """다른 저장소의 행을 가져옵니다. overwrite가 False면 이미 있는 키는 건너뜁니다."""
+        values = [tuple(str(row.get(col, '')) for col in self.columns) for row in rows
+                  if all(row.get(col) for col in self.key_columns)]
+        self.db.executemany(self._upsert_sql(overwrite=overwrite), values)
+
+class SQLiteUsers(SQLiteTable):
+    table = "users"
+    columns = tuple(SHEET_SCHEMAS["users"])
+    key_columns = ("student_id",)
+
+    def get_user(self, student_id):
+        rows = self.db.query("SELECT * FROM users WHERE student_id = ?", (str(student_id),))
+        return rows[0] if rows else None
+
+    def student_ids(self):
+        return [row['student_id'] for row in self.db.query("SELECT student_id FROM users ORDER BY rowid")]
+
+    def update_password(self, student_id, new_password):
+        if self.get_user(student_id) is None:
+            return False
+        self.db.execute("UPDATE users SET password = ?, password_changed = 'TRUE' WHERE student_id = ?",
+                        (new_password, str(student_id)))
+        return True
+
+class SQLiteSubmissions(SQLiteTable):
+    table = "submissions"
+    columns = tuple(SHEET_SCHEMAS["submissions"])
+    key_columns = ("student_id", "class_name")
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._rebuild_aggregates()
+
+    def _rebuild_aggregates(self):
+        aggregates = SubmissionAggregates()
+        for row in self.records():
+            aggregates.apply(row)
+        self.aggregates = aggregates
+
+    def import_rows(self, rows, overwrite=False):
+        super().import_rows(rows, overwrite)
+        self._rebuild_aggregates()
+
+    def latest_submission(self, student_id, class_name):
+        rows = self.db.query("SELECT * FROM submissions WHERE student_id = ? AND class_name = ?",
+                             (str(student_id), class_name))
+        return rows[0] if rows else None
+
+    def upsert(self, student_id, class_name, fields):
+        row = {'student_id': str(student_id), 'class_name': class_name, **fields}
+        columns = [col for col in self.columns if col in row]
+        self.db.execute(self._upsert_sql(columns), tuple(str(row[col]) for col in columns))
+        self.aggregates.apply(self.latest_submission(student_id, class_name))
+
+    def class_names(self):
+        rows = self.db.query("SELECT class_name FROM submissions GROUP BY class_name ORDER BY MIN(rowid)")
+        return [row['class_name'] for row in rows]
+
+    def students_in_class(self, class_name):
+        rows = self.db.query("SELECT student_id FROM submissions WHERE class_name = ? ORDER BY rowid", (class_name,))
+        return [row['student_id'] for row in rows]
+
+    def class_summary(self, class_name):
+        return self.aggregates.summary(class_name)
+
+class SQLiteAssessments(SQLiteTable):
+    table = "assessments"
+    columns = tuple(SHEET_SCHEMAS["assessments"])
+    key_columns = ("student_id", "class_name")
+
+    def get_assessment(self, student_id, class_name):
+        rows = self.db.query("SELECT * FROM assessments WHERE student_id = ? AND class_name = ?",
+                             (str(student_id), class_name))
+        return rows[0] if rows else None
+
+    def save_assessment(self, student_id, class_name, content_hash, assessment):
+        self.db.execute(self._upsert_sql(), (str(student_id), class_name, current_timestamp(), content_hash, assessment))
+
+class MirroredTable:
+    """SQLite 테이블을 기본으로 쓰고, 쓰기를 같은 이름의 시트 저장소에도 복제합니다.
+
+    시트 저장소의 쓰기는 큐에 쌓였다가 백그라운드에서 전송되므로 응답을 늦추지 않습니다.
+    mirror_wins가 True인 테이블(users)은 교사가 시트에서 직접 고친 내용을 시트의
+    version이 바뀔 때마다 SQLite로 다시 가져옵니다.
+    """
+
+    WRITE_METHODS = ('update_password', 'upsert', 'save_assessment')
+
+    def __init__(self, primary, mirror, mirror_wins=False):
+        self.primary = primary
+        self.mirror = mirror
+        self.mirror_wins = mirror_wins
+        self._synced_version = None
+        self.sync()
+
+    def sync(self):
+        if self._synced_version == self.mirror.version:
+            return
+        self._synced_version = self.mirror.version
+        self.primary.import_rows(self.mirror.records(), overwrite=self.mirror_wins)
+
+    @property
+    def version(self):
+        """시트에서 직접 고친 내용도 반영되도록 시트 저장소의 version을 따릅니다."""
+        return self.mirror.version
+
+    def invalidate(self):
+        self.mirror.invalidate()
+
+    def __len__(self):
+        return len(self.primary)
+
+    def __getattr__(self, name):
+        attr = getattr(self.primary, name)
+        if name not in self.WRITE_METHODS:
+            if self.mirror_wins:
+                self.mirror.maybe_refresh()
+                self.sync()
+            return attr
+
+        def write(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            try:
+                getattr(self.mirror, name)(*args, **kwargs)
+            except Exception:
+                # 시트 복제가 실패해도 SQLite에는 이미 저장되었습니다.
+                pass
+            return result
+        return write
+
+def get_sheets_storage(gs):
+    users_sheet = get_sheet(gs, "users")
+    submissions_sheet = get_sheet(gs, "submissions")
+    assessments_sheet = get_sheet(gs, "assessments")
+    if not users_sheet or not submissions_sheet or not assessments_sheet:
+        return None
+    return Storage(
+        "sheets",
+        get_sheet_store("users", users_sheet),
+        get_sheet_store("submissions", submissions_sheet),
+        get_sheet_store("assessments", assessments_sheet),
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_sqlite_storage(path):
+    db = SQLiteDatabase(path)
+    return Storage("sqlite", SQLiteUsers(db), SQLiteSubmissions(db), SQLiteAssessments(db))
+
+@st.cache_resource(show_spinner=False)
+def get_mirrored_storage(path, _sheets_storage):
+    """처음 만들 때 시트에만 있는 행을 SQLite로 가져옵니다."""
+    sqlite_storage = get_sqlite_storage(path)
+    return Storage(
+        "sqlite+sheets",
+        MirroredTable(sqlite_storage.users, _sheets_storage.users, mirror_wins=True),
+        MirroredTable(sqlite_storage.submissions, _sheets_storage.submissions),
+        MirroredTable(sqlite_storage.assessments, _sheets_storage.assessments),
+    )
+
+@instrumented("sheets")
+def import_sheets_into_sqlite(sqlite_storage, gs):
+    """비어 있는 SQLite 테이블을 같은 이름의 구글 시트 내용으로 채웁니다.
+
+    "sqlite" 백엔드로 처음 시작할 때 교사가 users 탭에 입력해 둔 학생 명단과 기존
+    제출물을 가져오기 위해 한 번 호출합니다. 이미 행이 있는 테이블은 건드리지 않습니다.
+    """
+    for name in ("users", "submissions", "assessments"):
+        table = getattr(sqlite_storage, name)
+        if len(table):
+            continue
+        worksheet = get_sheet(gs, name)
+        if worksheet is None:
+            return False
+        values = worksheet.get_all_values()
+        if len(values) > 1:
+            headers = values[0]
+            table.import_rows([dict(zip(headers, row)) for row in values[1:]])
+    return True
+
+@st.cache_resource(show_spinner=False)
+def get_standalone_sqlite_storage(path, import_from_sheets, _gs):
+    """"sqlite" 백엔드 저장소. import_from_sheets면 처음 만들 때 빈 테이블을 시트에서 채웁니다."""
+    sqlite_storage = get_sqlite_storage(path)
+    if import_from_sheets:
+        try:
+            import_sheets_into_sqlite(sqlite_storage, _gs)
+        except Exception as e:
+            st.warning(f"구글 시트에서 학생 명단을 가져오지 못했습니다: {e}")
+    return sqlite_storage
+
+def get_storage(gs):
+    """Secrets의 [storage] 설정에 맞는 저장소를 반환합니다. 실패하면 None."""
+    settings = st.secrets.get("storage", {})
+    backend = settings.get("backend", "sheets")
+    path = settings.get("sqlite_path", DEFAULT_SQLITE_PATH)
+    if backend not in STORAGE_BACKENDS:
+        st.error(f"알 수 없는 저장소 설정입니다: {backend} ({', '.join(STORAGE_BACKENDS)} 중 하나를 사용하세요)")
+        return None
+    if backend == "sqlite":
+        return get_standalone_sqlite_storage(path, bool(settings.get("import_from_sheets", True)), gs)
+    sheets_storage = get_sheets_storage(gs)
+    if sheets_storage is None:
+        return None
+    if backend == "sqlite+sheets":
+        return get_mirrored_storage(path, sheets_storage)
+    return sheets_storage
+
+# ----------------------------------------------------------------------
+# 로그인 인증 정보
+# ----------------------------------------------------------------------
+# 이 시간(초) 안에 실패가 한도를 넘으면 해당 ID 또는 IP의 로그인을 잠시 막습니다.
+# 한 교실이 같은 IP를 쓰는 경우가 많으므로 IP 한도는 넉넉하게 둡니다.
+# 교사 ID는 학생이 일부러 틀려서 잠글 수 없도록 IP별로 따로 셉니다.
+LOGIN_FAILURE_WINDOW = 5 * 60
+LOGIN_MAX_FAILURES_PER_ID = 5
+LOGIN_MAX_FAILURES_PER_IP = 30
+LOGIN_MAX_TEACHER_FAILURES_PER_IP = 5
+# 없는 학번을 기억하는 시간(초)과 최대 건수. 이 동안은 같은 학번으로 시트를 다시 읽지 않습니다.
+UNKNOWN_ID_TTL = 60
+UNKNOWN_ID_MAX_ENTRIES = 1000
+# 없는 학번 때문에 명단을 다시 읽는 최소 간격(초)
+USERS_RELOAD_MIN_INTERVAL = 10
+# 실패 기록을 보관하는 ID/IP 수가 이보다 많아지면 오래된 기록을 정리합니다.
+LOGIN_THROTTLE_MAX_KEYS = 10000
+
+def client_ip():
+    """요청한 브라우저의 IP. 알 수 없으면 None.
+
+    X-Forwarded-For는 브라우저가 마음대로 채울 수 있으므로 secrets의 [login]
+    trusted_proxies에 앱 앞의 프록시 수를 적었을 때만 씁니다. 이때는 믿을 수 있는
+    프록시가 덧붙인 값, 즉 오른쪽에서 trusted_proxies번째 주소를 사용합니다.
+    """
     try:
-        worksheet = spreadsheet.worksheet(sheet_name)
-    except gspread.exceptions.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title=sheet_name, rows="100", cols="20")
-        if sheet_name == "users":
-            worksheet.append_row(["student_id", "password", "password_changed"])
-        elif sheet_name == "submissions":
-             worksheet.append_row(["student_id", "class_name", "timestamp", "submission_content", "feedback", "record_suggestion"])
-    
-    if sheet_name == "users":
-        headers = worksheet.row_values(1)
-        if "password_changed" not in headers:
-            worksheet.update_cell(1, len(headers) + 1, "password_changed")
+        trusted_proxies = int(st.secrets.get("login", {}).get("trusted_proxies", 0))
+        forwarded = st.context.headers.get("X-Forwarded-For", "")
+        if trusted_proxies > 0 and forwarded:
+            addresses = [address.strip() for address in forwarded.split(",") if address.strip()]
+            if len(addresses) >= trusted_proxies:
+                return addresses[-trusted_proxies]
+        ip = st.context.ip_address
+        return ip if isinstance(ip, str) and ip else None
+    except Exception:
+        return None
+
+class LoginThrottle:
+    """최근 window초 동안의 로그인 실패 횟수로 키(ID 또는 IP)별 시도를 막습니다."""
+
+    def __init__(self, limit, window=LOGIN_FAILURE_WINDOW):
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._failures = {}
+
+    def _recent(self, key, now):
+        failures = [at for at in self._failures.get(key, ()) if now - at < self.window]
+        if failures:
+            self._failures[key] = failures
+        else:
+            self._failures.pop(key, None)
+        return failures
+
+    def retry_after(self, key):
+        """막혀 있으면 다시 시도할 수 있을 때까지 남은 초, 아니면 0."""
+        if key is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            failures = self._recent(key, now)
+            if len(failures) < self.limit:
+                return 0
+            return self.window - (now - failures[-self.limit])
+
+    def fail(self, key):
+        if key is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._failures.setdefault(key, []).append(now)
+            if len(self._failures) > LOGIN_THROTTLE_MAX_KEYS:
+                for stale in list(self._failures):
+                    self._recent(stale, now)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+class CredentialStore:
+    """로그인에 쓰는 학생 인증 정보를 메모리에 보관합니다.
 
-    return worksheet
+    users 저장소를 한 번 읽어 {student_id: {'hash', 'password_changed'}}로 만들고,
+    저장소의 version이 바뀔 때만 다시 만듭니다. 비밀번호는 프로세스마다 새로 만든 키로
+    HMAC 해시해 보관하므로 로그인은 원격 호출 없이 끝납니다. 없는 학번은 잠시 기억해
+    두었다가 같은 학번이 다시 들어와도 명단을 또 읽지 않습니다.
+    """
+
+    def __init__(self, users_store):
+        self.users_store = users_store
+        self.id_throttle = LoginThrottle(LOGIN_MAX_FAILURES_PER_ID)
+        self.ip_throttle = LoginThrottle(LOGIN_MAX_FAILURES_PER_IP)
+        self.teacher_throttle = LoginThrottle(LOGIN_MAX_TEACHER_FAILURES_PER_IP)
+        self._key = os.urandom(32)
+        self._lock = threading.Lock()
+        self._credentials = {}
+        self._version = None
+        self._unknown = OrderedDict()  # student_id -> 만료 시각
+        self._reload_requested_at = 0.0
+
+    def _hash(self, password):
+        return hmac.new(self._key, str(password).encode('utf-8'), hashlib.sha256).digest()
+
+    def _sync(self):
+        """저장소가 바뀌었으면 인증 정보를 다시 만듭니다."""
+        self.users_store.maybe_refresh()
+        version = self.users_store.version
+        if version == self._version:
+            return
+        credentials = {
+            str(row['student_id']): {
+                'hash': self._hash(row.get('password', '')),
+                'password_changed': str(row.get('password_changed', '')).upper() == 'TRUE',
+            }
+            for row in self.users_store.records() if row.get('student_id')
+        }
+        with self._lock:
+            self._credentials, self._version = credentials, version
+            self._unknown.clear()
+
+    def __len__(self):
+        self._sync()
+        return len(self._credentials)
+
+    def retry_after(self, user_id, ip, is_teacher=False):
+        """ID나 IP가 막혀 있으면 남은 초, 아니면 0.
+
+        교사 ID는 ID 전체가 아니라 IP별로만 막으므로, 다른 IP에서 틀린 시도가 쌓여도
+        교사는 로그인할 수 있습니다. 공유 IP 한도도 교사에게는 적용하지 않습니다.
+        """
+        if is_teacher:
+            return self.teacher_throttle.retry_after(ip or "-")
+        return max(self.id_throttle.retry_after(str(user_id)), self.ip_throttle.retry_after(ip))
+
+    def record_failure(self, user_id, ip, is_teacher=False):
+        if is_teacher:
+            self.teacher_throttle.fail(ip or "-")
+        else:
+            self.id_throttle.fail(str(user_id))
+        self.ip_throttle.fail(ip)
+
+    def record_success(self, user_id, ip=None, is_teacher=False):
+        if is_teacher:
+            self.teacher_throttle.reset(ip or "-")
+        else:
+            self.id_throttle.reset(str(user_id))
 
-def login(users_sheet):
+    def verify(self, student_id, password):
+        """비밀번호가 맞으면 {'password_changed': bool}, 아니면 None."""
+        student_id = str(student_id)
+        self._sync()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._credentials.get(student_id)
+            reload = False
+            if entry is None and self._unknown.get(student_id, 0) <= now:
+                # 교사가 방금 추가한 학생일 수 있으므로 명단을 한 번 다시 읽게 합니다.
+                self._unknown[student_id] = now + UNKNOWN_ID_TTL
+                self._unknown.move_to_end(student_id)
+                while len(self._unknown) > UNKNOWN_ID_MAX_ENTRIES:
+                    self._unknown.popitem(last=False)
+                if now - self._reload_requested_at >= USERS_RELOAD_MIN_INTERVAL:
+                    self._reload_requested_at = now
+                    reload = True
+        if entry is None:
+            if reload:
+                self.users_store.invalidate()
+                self.users_store.maybe_refresh()
+            return None
+        if not hmac.compare_digest(entry['hash'], self._hash(password)):
+            return None
+        return {'password_changed': entry['password_changed']}
+
+    def update_password(self, student_id, new_password):
+        """저장소의 비밀번호를 바꾸고 메모리의 인증 정보도 그 자리에서 고칩니다."""
+        if not self.users_store.update_password(student_id, new_password):
+            return False
+        with self._lock:
+            self._credentials[str(student_id)] = {'hash': self._hash(new_password), 'password_changed': True}
+        return True
+
+@st.cache_resource(show_spinner=False)
+def get_credential_store(backend, _users_store):
+    return CredentialStore(_users_store)
+
+def login(credentials):
     """로그인 UI를 표시하고 학생/교사 인증을 처리합니다."""
     st.header("🤖 AI 기반 학생 피드백 시스템")
     st.markdown("---")
@@ -90,32 +1383,39 @@ def login(users_sheet):
             submitted = st.form_submit_button("로그인")
 
             if submitted:
+                ip = client_ip()
                 teacher_creds = st.secrets.get("teacher_account", {})
-                if user_id == teacher_creds.get("id") and password == teacher_creds.get("password"):
-                    st.session_state['logged_in'] = True
-                    st.session_state['user_id'] = user_id
-                    st.session_state['is_teacher'] = True
-                    st.rerun()
+                is_teacher = bool(user_id) and user_id == teacher_creds.get("id")
+                wait = credentials.retry_after(user_id, ip, is_teacher)
+                if wait:
+                    st.error(f"로그인 시도가 너무 많습니다. {math.ceil(wait)}초 후에 다시 시도해주세요.")
+                    return
+                if is_teacher:
+                    if password == teacher_creds.get("password"):
+                        credentials.record_success(user_id, ip, is_teacher=True)
+                        st.session_state['logged_in'] = True
+                        st.session_state['user_id'] = user_id
+                        st.session_state['is_teacher'] = True
+                        st.rerun()
+                    else:
+                        credentials.record_failure(user_id, ip, is_teacher=True)
+                        st.error("아이디 또는 비밀번호가 올바르지 않습니다.")
                 else:
-                    users_df = pd.DataFrame(users_sheet.get_all_records())
-                    if users_df.empty:
+                    if not len(credentials):
                         st.error("등록된 학생 정보가 없습니다.")
                         return
 
-                    user_row = users_df[(users_df['student_id'].astype(str) == user_id) & (users_df['password'].astype(str) == password)]
+                    user = credentials.verify(user_id, password)
                     
-                    if not user_row.empty:
+                    if user is not None:
+                        credentials.record_success(user_id)
                         st.session_state['logged_in'] = True
                         st.session_state['user_id'] = user_id
                         st.session_state['is_teacher'] = False
-                        
-                        password_changed_val = user_row.get('password_changed', pd.Series(False)).iloc[0]
-                        if str(password_changed_val).upper() != 'TRUE':
-                            st.session_state['password_needs_change'] = True
-                        else:
-                            st.session_state['password_needs_change'] = False
+                        st.session_state['password_needs_change'] = not user['password_changed']
                         st.rerun()
                     else:
+                        credentials.record_failure(user_id, ip)
                         st.error("아이디 또는 비밀번호가 올바르지 않습니다.")
 
 def logout():
@@ -125,7 +1425,7 @@ def logout():
             del st.session_state[key]
         st.rerun()
 
-def change_password_view(users_sheet):
+def change_password_view(credentials):
     """학생이 첫 로그인 시 비밀번호를 변경하도록 하는 UI를 표시합니다."""
     st.header("🔒 비밀번호 변경")
     st.info("시스템에 처음 로그인하셨습니다. 보안을 위해 비밀번호를 변경해주세요.")
@@ -143,9 +1443,8 @@ def change_password_view(users_sheet):
             else:
                 try:
                     student_id = st.session_state['user_id']
-                    cell = users_sheet.find(student_id)
-                    users_sheet.update_cell(cell.row, 2, new_password)
-                    users_sheet.update_cell(cell.row, 3, 'TRUE')
+                    if not credentials.update_password(student_id, new_password):
+                        raise KeyError(student_id)
                     st.session_state['password_needs_change'] = False
                     st.success("비밀번호가 성공적으로 변경되었습니다. 이제 앱을 사용하실 수 있습니다.")
                     st.balloons()
@@ -156,7 +1455,18 @@ def change_password_view(users_sheet):
 # ----------------------------------------------------------------------
 # 템플릿 처리 및 AI 피드백 함수
 # ----------------------------------------------------------------------
+CLASS_LIST = {
+    "자유 낙하와 수평 방향으로 던진 물체의 운동 비교" : "1AnUqkNgFwO6EwX3p3JaVhk8bOT7-TONIdT9sl-lis_U",
+    "전자기 유도" : "1U9nOSDH3EXF0dX0rvkpiTfk7w61Wy90PDWf-uM9QnHY"
+}
+# 캐시된 템플릿의 revisionId를 다시 확인하는 주기(초). revisionId를 받을 수 없는
+# 문서는 TEMPLATE_MAX_AGE가 지나면 본문을 다시 가져옵니다.
+TEMPLATE_CHECK_INTERVAL = 30
+TEMPLATE_MAX_AGE = 600
+
+@instrumented("docs")
 def get_doc_content(docs_service, document_id):
+    """문서 본문 텍스트와 revisionId를 반환합니다. 실패하면 (None, None)."""
     try:
         document = docs_service.documents().get(documentId=document_id).execute()
         content = document.get('body').get('content')
@@ -169,10 +1479,17 @@ def get_doc_content(docs_service, document_id):
                     if text_run:
                         text += text_run.get('content', '')
                 text += '\n'
-        return text
+        return text, document.get('revisionId')
     except Exception as e:
-        return None
+        return None, None
+
+@instrumented("docs")
+def get_doc_revision(docs_service, document_id):
+    """본문 없이 revisionId만 가져옵니다."""
+    document = docs_service.documents().get(documentId=document_id, fields='revisionId').execute()
+    return document.get('revisionId')
 
+@instrumented("app")
 def parse_template_by_activity(template_text):
     activities = OrderedDict()
     input_pattern = re.compile(r'\{\{([^:}]+)(?::([^}]+))?\}\}')
@@ -200,83 +1517,550 @@ def parse_template_by_activity(template_text):
         activities[activity_title] = {'parts': activity_parts, 'exemplar': exemplar_text}
     return activities
 
-def load_previous_submission(submissions_sheet, student_id, class_name):
+class TemplateCache:
+    """문서 ID별로 파싱된 활동 구조를 보관합니다.
+
+    TEMPLATE_CHECK_INTERVAL마다 revisionId만 가볍게 확인하고, 문서가 바뀐 경우에만
+    본문을 다시 받아 파싱합니다.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _fetch(self, docs_service, document_id):
+        template_text, revision_id = get_doc_content(docs_service, document_id)
+        if not template_text:
+            return None
+        activities = parse_template_by_activity(template_text)
+        for data in activities.values():
+            data['exemplar_digest'] = condense_exemplar(data['exemplar'])
+        now = time.monotonic()
+        entry = {
+            'activities': activities,
+            'revision_id': revision_id,
+            'fetched_at': now,
+            'checked_at': now,
+        }
+        with self._lock:
+            self._entries[document_id] = entry
+        return entry['activities']
+
+    def get(self, docs_service, document_id):
+        """파싱된 activities를 반환합니다. 문서를 가져오지 못하면 None."""
+        with self._lock:
+            entry = self._entries.get(document_id)
+        if entry is None:
+            return self._fetch(docs_service, document_id)
+        now = time.monotonic()
+        if now - entry['checked_at'] < TEMPLATE_CHECK_INTERVAL:
+            return entry['activities']
+        if entry['revision_id'] is None:
+            if now - entry['fetched_at'] < TEMPLATE_MAX_AGE:
+                return entry['activities']
+            return self._fetch(docs_service, document_id) or entry['activities']
+        try:
+            revision_id = get_doc_revision(docs_service, document_id)
+        except Exception:
+            # 확인에 실패하면 캐시된 템플릿을 계속 사용합니다.
+            revision_id = entry['revision_id']
+        if revision_id == entry['revision_id']:
+            entry['checked_at'] = now
+            return entry['activities']
+        return self._fetch(docs_service, document_id) or entry['activities']
+
+    def prefetch(self, docs_service, document_ids):
+        for document_id in document_ids:
+            self._fetch(docs_service, document_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+@st.cache_resource(show_spinner=False)
+def get_template_cache():
+    return TemplateCache()
+
+def load_previous_submission(submissions_store, student_id, class_name):
     try:
-        submissions_df = pd.DataFrame(submissions_sheet.get_all_records())
-        if submissions_df.empty: return {}, ""
-        student_submissions = submissions_df[(submissions_df['student_id'].astype(str) == str(student_id)) & (submissions_df['class_name'] == class_name)]
-        if not student_submissions.empty:
-            latest_submission = student_submissions.sort_values(by='timestamp', ascending=False).iloc[0]
+        latest_submission = submissions_store.latest_submission(student_id, class_name)
+        if latest_submission is not None:
             content = latest_submission['submission_content']
             if content and content.strip(): return json.loads(content), latest_submission['feedback']
             else: return {}, latest_submission['feedback']
     except Exception: pass
     return {}, ""
 
-def save_submission(submissions_sheet, student_id, class_name, submission_content, feedback, record_suggestion):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def load_activity_feedback(submissions_store, student_id, class_name):
+    """마지막 제출의 (활동별 피드백, 통합 생기부 초안)을 읽습니다.
+
+    활동별 피드백은 {활동 제목: {'hash', 'feedback', 'record_suggestion'}}이며,
+    record_suggestion은 활동 하나의 세특 조각입니다.
+    """
+    try:
+        latest_submission = submissions_store.latest_submission(student_id, class_name)
+        if latest_submission is not None and (latest_submission.get('activity_feedback') or '').strip():
+            return json.loads(latest_submission['activity_feedback']), latest_submission.get('record_suggestion') or None
+    except Exception: pass
+    return {}, None
+
+@instrumented("app")
+def save_submission(submissions_store, student_id, class_name, submission_content, feedback, record_suggestion,
+                    activity_feedback=None):
     submission_json = json.dumps(submission_content, ensure_ascii=False)
-    df = pd.DataFrame(submissions_sheet.get_all_records())
-    if df.empty or 'student_id' not in df.columns: existing_row = pd.DataFrame()
-    else: existing_row = df[(df['student_id'].astype(str) == str(student_id)) & (df['class_name'] == class_name)]
-    if not existing_row.empty:
-        row_index = existing_row.index[0] + 2
-        submissions_sheet.update_cell(row_index, 3, timestamp)
-        submissions_sheet.update_cell(row_index, 4, submission_json)
-        submissions_sheet.update_cell(row_index, 5, feedback)
-        submissions_sheet.update_cell(row_index, 6, record_suggestion)
-    else:
-        new_row = [student_id, class_name, timestamp, submission_json, feedback, record_suggestion]
-        submissions_sheet.append_row(new_row)
+    fields = {
+        'timestamp': current_timestamp(),
+        'submission_content': submission_json,
+        'feedback': feedback,
+        'record_suggestion': record_suggestion,
+    }
+    if activity_feedback is not None:
+        fields['activity_feedback'] = json.dumps(activity_feedback, ensure_ascii=False)
+    submissions_store.upsert(student_id, class_name, fields)
 
-# [수정] API 요청을 하나로 통합한 함수
-def get_ai_feedback(model, class_name, submission_content, all_exemplars_text):
-    """하나의 API 호출로 피드백과 생기부 초안을 모두 생성합니다."""
-    full_text = f"## 수업: {class_name}\n\n"
-    submitted_items = {k: v for k, v in submission_content.items() if v and v.strip()}
-    if not submitted_items:
-        return "제출된 내용이 없어 피드백을 생성할 수 없습니다.", "제출된 내용이 없어 생기부 초안을 생성할 수 없습니다."
+# ----------------------------------------------------------------------
+# AI 응답 캐시
+# ----------------------------------------------------------------------
+# 프롬프트 문구를 바꾸면 해당 버전을 올려 이전 응답이 재사용되지 않도록 합니다.
+PROMPT_VERSIONS = {"feedback": 2, "assessment": 1}
+RESPONSE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_response_cache.sqlite3")
+RESPONSE_CACHE_TTL = 60 * 60 * 24 * 30
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+
+class ResponseCache:
+    """Gemini 응답을 내용 해시로 저장하는 SQLite 캐시입니다.
+
+    로컬 디스크에 저장되므로 앱을 다시 시작해도 유지됩니다. TTL이 지난 항목과,
+    RESPONSE_CACHE_MAX_ENTRIES를 넘는 가장 오래 사용하지 않은 항목은 저장할 때 지웁니다.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return ResponseCache()
+
+def normalize_text(text):
+    return ' '.join(str(text).split())
+
+def response_cache_key(kind, exemplar_text, content):
+    """모델 이름, 프롬프트 버전, 참고자료, 정규화된 제출 내용으로 캐시 키를 만듭니다."""
+    payload = json.dumps(
+        [GEMINI_MODEL_NAME, kind, PROMPT_VERSIONS[kind], normalize_text(exemplar_text or ""), content],
+        ensure_ascii=False, sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-    for label, content in submitted_items.items():
-        full_text += f"### {label}\n{content}\n\n"
+# ----------------------------------------------------------------------
+# 프롬프트 크기 관리
+# ----------------------------------------------------------------------
+# 피드백 요청 한 번의 입력 토큰 예산. Secrets의 [prompt] token_budget으로 바꿀 수 있습니다.
+PROMPT_TOKEN_BUDGET = 6000
+# 활동 하나의 참고자료 요약본이 넘지 않을 토큰 수
+EXEMPLAR_DIGEST_TOKENS = 600
+TRUNCATION_MARK = " …(이하 생략)"
+
+def prompt_token_budget():
+    return int(st.secrets.get("prompt", {}).get("token_budget", PROMPT_TOKEN_BUDGET))
+
+def _char_tokens(ch):
+    # 한글·한자 등은 글자당 약 1토큰, 영문·숫자·기호는 4글자당 약 1토큰입니다.
+    return 1.0 if ord(ch) >= 0x1100 else 0.25
+
+def estimate_tokens(text):
+    """API를 호출하지 않고 Gemini 입력 토큰 수를 어림합니다."""
+    return int(math.ceil(sum(_char_tokens(ch) for ch in text)))
+
+def truncate_to_tokens(text, max_tokens):
+    """어림 토큰 수가 max_tokens를 넘지 않도록 뒤쪽을 잘라냅니다."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens - estimate_tokens(TRUNCATION_MARK)
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += _char_tokens(ch)
+        if used > limit:
+            return text[:i].rstrip() + TRUNCATION_MARK if i else ""
+    return text
+
+def condense_exemplar(exemplar_text):
+    """참고자료에서 빈 줄, 중복 줄, 불필요한 공백을 없애고 EXEMPLAR_DIGEST_TOKENS로 줄입니다."""
+    lines, seen = [], set()
+    for line in exemplar_text.splitlines():
+        line = ' '.join(line.split())
+        if line and line not in seen:
+            seen.add(line)
+            lines.append(line)
+    return truncate_to_tokens('\n'.join(lines), EXEMPLAR_DIGEST_TOKENS)
+
+def fit_to_budget(submitted_items, exemplar_text, budget, build_prompt):
+    """build_prompt(submitted_items, exemplar_text)가 예산 안에 들도록 입력을 줄입니다.
+
+    참고자료를 먼저 줄이고, 제출 내용만으로도 예산을 넘으면 각 항목을 길이에 비례해
+    줄입니다. (submitted_items, exemplar_text, prompt, 어림 토큰 수)를 반환합니다.
+    입력을 모두 비워도 프롬프트 틀만으로 예산을 넘으면 ValueError를 일으킵니다.
+    """
+    template_tokens = estimate_tokens(build_prompt({label: "" for label in submitted_items}, ""))
+    if template_tokens >= budget:
+        raise ValueError(f"프롬프트 토큰 예산({budget})이 프롬프트 기본 틀({template_tokens})보다 작습니다. "
+                         "Secrets의 [prompt] token_budget을 늘려 주세요.")
+    base_tokens = estimate_tokens(build_prompt(submitted_items, ""))
+    if exemplar_text:
+        exemplar_tokens = estimate_tokens(build_prompt(submitted_items, exemplar_text)) - base_tokens
+        overhead = exemplar_tokens - estimate_tokens(exemplar_text)
+        exemplar_text = truncate_to_tokens(exemplar_text, max(0, budget - base_tokens - overhead))
+    if base_tokens > budget:
+        item_tokens = {label: estimate_tokens(content) for label, content in submitted_items.items()}
+        total = sum(item_tokens.values())
+        available = max(0, budget - (base_tokens - total))
+        submitted_items = {label: truncate_to_tokens(content, int(item_tokens[label] * available / total))
+                           for label, content in submitted_items.items()}
+    prompt = build_prompt(submitted_items, exemplar_text)
+    return submitted_items, exemplar_text, prompt, estimate_tokens(prompt)
+
+# ----------------------------------------------------------------------
+# AI 피드백 생성 함수
+# ----------------------------------------------------------------------
+# 응답을 스트리밍으로 받아 도착하는 대로 화면에 표시할지 여부
+STREAM_RESPONSES = True
+FEEDBACK_FIELDS = ("feedback", "record_suggestion")
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def extract_partial_json_fields(text, fields, start=0, end=None):
+    """아직 끝나지 않은 JSON 텍스트에서 문자열 필드의 현재까지 값을 꺼냅니다.
+
+    값이 닫히지 않았으면 지금까지 받은 부분만 돌려주고, 끝이 잘린 이스케이프 문자열은
+    버립니다. 아직 나타나지 않은 필드는 결과에 포함하지 않습니다. start와 end가
+    주어지면 text[start:end] 안에서 처음 나오는 필드만 찾습니다.
+    """
+    end = len(text) if end is None else end
+    values = {}
+    for field in fields:
+        match = re.compile(r'"%s"\s*:\s*"' % re.escape(field)).search(text, start, end)
+        if not match:
+            continue
+        chars, i = [], match.end()
+        while i < end:
+            ch = text[i]
+            if ch == '"':
+                break
+            if ch == '\\':
+                if i + 1 >= len(text):
+                    break
+                escape = text[i + 1]
+                if escape == 'u':
+                    if i + 6 > len(text):
+                        break
+                    try:
+                        chars.append(chr(int(text[i + 2:i + 6], 16)))
+                    except ValueError:
+                        pass
+                    i += 6
+                    continue
+                chars.append(JSON_ESCAPES.get(escape, escape))
+                i += 2
+                continue
+            chars.append(ch)
+            i += 1
+        values[field] = ''.join(chars)
+    return values
+
+def json_object_end(text, start):
+    """text[start]가 여는 중괄호 바로 뒤일 때 그 객체를 닫는 중괄호의 위치. 아직 닫히지 않았으면 len(text)."""
+    depth, in_string, i = 1, False, start
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            if ch == '\\':
+                i += 1
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return len(text)
+
+def extract_partial_activity_fields(text, titles, fields=FEEDBACK_FIELDS):
+    """아직 끝나지 않은 JSON 텍스트의 "activities"에서 활동별 필드 값을 꺼냅니다.
+
+    {활동 제목: {필드: 지금까지 받은 값}}을 반환하며, 아직 나타나지 않은 활동은 빠집니다.
+    필드는 그 활동의 객체 안에서만 찾으므로 다른 활동이나 바깥 객체의 값을 가져오지 않습니다.
+    """
+    values = {}
+    for title in titles:
+        match = re.search(r'%s\s*:\s*\{' % re.escape(json.dumps(title, ensure_ascii=False)), text)
+        if match:
+            values[title] = extract_partial_json_fields(text, fields, match.end(), json_object_end(text, match.end()))
+    return values
+
+def build_feedback_prompt(class_name, submitted_items, all_exemplars_text, other_records=None):
+    """여러 활동의 피드백과 통합 생기부 초안을 한 번에 요청하는 프롬프트를 만듭니다.
+
+    submitted_items는 {(활동 제목, 레이블): 내용}입니다. other_records는 이번에 다시
+    분석하지 않는 활동의 {활동 제목: 세특 조각}으로, 통합 초안에 함께 반영하도록 넣습니다.
+    """
+    activities = {}
+    for (title, label), content in submitted_items.items():
+        activities.setdefault(title, []).append(f"#### {label}\n{content}\n\n")
+    full_text = f"## 수업: {class_name}\n\n"
+    for title, parts in activities.items():
+        full_text += f"### 활동: {title}\n" + "".join(parts)
     
     context_prompt = ""
     if all_exemplars_text and all_exemplars_text.strip():
         context_prompt = f"[교사 제공 참고자료 (모범답안/평가 기준)]\n{all_exemplars_text}\n\n"
-    
-    prompt = f"""
-당신은 대한민국 고등학교 교사로서, 학생의 제출물을 분석하고 두 가지 결과물을 JSON 형식으로 출력해야 합니다.
+    other_prompt = ""
+    if other_records:
+        other_prompt = "[이미 분석한 다른 활동의 세특 조각]\n" + "".join(
+            f"- {title}: {record}\n" for title, record in other_records.items()) + "\n"
 
-{context_prompt}
+    activity_fields = ",\n".join(
+        f'    {json.dumps(title, ensure_ascii=False)}: {{"feedback": "...", "record_suggestion": "..."}}'
+        for title in activities)
+    prompt = f"""
+당신은 대한민국 고등학교 교사로서, 학생의 제출물을 활동별로 분석하고 결과물을 JSON 형식으로 출력해야 합니다.
 
+{context_prompt}{other_prompt}
 [학생 제출 내용]
 {full_text}
-
 [요청 사항]
-아래 두 항목에 대한 내용을 각각 작성하여, 반드시 다음 JSON 형식에 맞춰 한 번에 출력해주세요.
+아래 항목을 작성하여, 반드시 다음 JSON 형식에 맞춰 한 번에 출력해주세요.
+- activities의 각 활동 "feedback": 해당 활동에 대해 학생을 위한 건설적인 피드백을 작성합니다. (칭찬, 개선점, 심화 탐구 제안 포함, 격려하는 어조 사용)
+- activities의 각 활동 "record_suggestion": 해당 활동에서 드러난 핵심 역량을 개조식 한 문장으로 적은 '세특 조각'입니다. 활동 하나만 다루며, 생기부에 그대로 이어 붙이지 않고 통합 초안의 재료로만 씁니다.
+- 맨 아래 "record_suggestion": '과목별 세부능력 및 특기사항'에 기재할 통합 서술형 초안입니다. 위 활동들과 [이미 분석한 다른 활동의 세특 조각]을 모두 아울러 작성합니다. (핵심 역량, 과정 중심, 개조식 문체 사용, 전체 1~2문장 요약)
 
 {{
-  "feedback": "여기에 학생을 위한 건설적인 피드백을 작성합니다. (칭찬, 개선점, 심화 탐구 제안 포함, 격려하는 어조 사용)",
-  "record_suggestion": "여기에 '과목별 세부능력 및 특기사항'에 기재할 객관적인 서술형 초안을 작성합니다. (핵심 역량, 과정 중심, 개조식 문체 사용, 1~2문장 요약)"
+  "activities": {{
+{activity_fields}
+  }},
+  "record_suggestion": "..."
 }}
 """
+    return prompt
+
+def response_usage(response):
+    """응답의 usage_metadata에서 (입력 토큰, 출력 토큰)을 꺼냅니다. 없으면 None."""
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'prompt_token_count', None), getattr(usage, 'candidates_token_count', None)
+
+# [수정] API 요청을 하나로 통합한 함수
+def get_ai_feedback(model, class_name, activities, exemplars, other_records=None, limiter=None, cache=None,
+                    on_partial=None, token_budget=PROMPT_TOKEN_BUDGET, on_usage=None):
+    """여러 활동의 피드백과 통합 생기부 초안을 하나의 API 호출로 생성합니다.
+
+    activities는 {활동 제목: {레이블: 내용}}, exemplars는 {활동 제목: 참고자료}입니다.
+    백그라운드 작업에서 호출되므로 화면에 직접 출력하지 않고
+    ({활동 제목: {'feedback', 'record_suggestion'}}, 통합 생기부 초안, 오류 메시지)를
+    돌려줍니다. 응답에서 빠진 활동은 첫 번째 값에 들어가지 않습니다. on_partial이
+    주어지면 스트리밍 중 {활동 제목: {필드: 값}}을 전달합니다. 프롬프트는 token_budget
+    안으로 줄이고, 사용한 토큰 수는 on_usage로 전달합니다.
+    """
+    submitted_items = {(title, label): content for title, items in activities.items()
+                       for label, content in items.items() if content and content.strip()}
+    if not submitted_items:
+        return {}, "제출된 내용이 없어 생기부 초안을 생성할 수 없습니다.", None
+
+    all_exemplars_text = "\n\n".join(f"### {title}\n{exemplar}" for title, exemplar in exemplars.items()
+                                     if title in activities and exemplar and exemplar.strip())
+    try:
+        submitted_items, all_exemplars_text, prompt, estimated_tokens = fit_to_budget(
+            submitted_items, all_exemplars_text, token_budget,
+            lambda items, exemplars_text: build_feedback_prompt(class_name, items, exemplars_text, other_records),
+        )
+    except ValueError as e:
+        return {}, "생기부 초안을 생성하지 못했습니다.", str(e)
+    titles = list(dict.fromkeys(title for title, _ in submitted_items))
+    usage = {'estimated_prompt_tokens': estimated_tokens, 'token_budget': token_budget,
+             'prompt_tokens': None, 'output_tokens': None, 'cached': False}
+
+    submission = {}
+    for (title, label), content in submitted_items.items():
+        submission.setdefault(title, {})[label] = normalize_text(content)
+    cache_key = response_cache_key(
+        "feedback", all_exemplars_text,
+        {'class_name': class_name, 'submission': submission, 'other_records': other_records or {}},
+    )
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        if on_usage is not None:
+            on_usage({**usage, 'cached': True})
+        return cached['activities'], cached['record_suggestion'], None
+
     try:
-        with st.spinner("AI가 피드백과 생기부 초안을 분석하고 있습니다..."):
-            response = model.generate_content(prompt)
-            # JSON 파싱
-            result = json.loads(response.text)
-            feedback = result.get("feedback", "피드백을 생성하지 못했습니다.")
-            record_suggestion = result.get("record_suggestion", "생기부 초안을 생성하지 못했습니다.")
-        return feedback, record_suggestion
+        on_text = None
+        if on_partial is not None and STREAM_RESPONSES:
+            on_text = lambda text: on_partial(extract_partial_activity_fields(text, titles))
+        response = generate_with_retry(model, prompt, limiter, on_text)
+        if on_usage is not None:
+            usage['prompt_tokens'], usage['output_tokens'] = response_usage(response)
+            on_usage(usage)
+        # JSON 파싱
+        result = json.loads(response.text)
+        if not isinstance(result, dict):
+            raise json.JSONDecodeError("JSON 객체가 아닙니다.", response.text, 0)
+        results = {
+            title: {'feedback': str(part['feedback']), 'record_suggestion': str(part.get('record_suggestion') or '')}
+            for title, part in (result.get("activities") or {}).items()
+            if title in titles and isinstance(part, dict) and part.get('feedback')
+        }
+        record_suggestion = result.get("record_suggestion") or "생기부 초안을 생성하지 못했습니다."
+        if len(results) < len(titles):
+            return results, record_suggestion, "AI 응답에 일부 활동의 피드백이 빠져 있습니다."
+        if cache is not None and result.get("record_suggestion"):
+            cache.put(cache_key, {'activities': results, 'record_suggestion': record_suggestion})
+        return results, record_suggestion, None
     except json.JSONDecodeError:
-        st.error("AI가 유효한 JSON 형식으로 응답하지 않았습니다. 일반 텍스트로 결과를 표시합니다.")
-        return response.text, "생기부 초안 생성에 실패했습니다 (JSON 파싱 오류)."
+        # 잘린 JSON이라도 활동별 피드백을 읽을 수 있으면 그 값을 사용합니다.
+        partial = {title: {'feedback': fields['feedback'], 'record_suggestion': fields.get('record_suggestion', '')}
+                   for title, fields in extract_partial_activity_fields(response.text, titles).items()
+                   if fields.get('feedback')}
+        if partial:
+            return partial, "생기부 초안 생성에 실패했습니다 (JSON 파싱 오류).", "AI 응답 형식이 올바르지 않아 일부 내용만 표시합니다."
+        return {}, "생기부 초안 생성에 실패했습니다 (JSON 파싱 오류).", "AI가 유효한 JSON 형식으로 응답하지 않았습니다."
     except Exception as e:
-        st.error(f"Gemini API 호출 중 오류가 발생했습니다: {e}")
-        return "피드백 생성 중 오류가 발생했습니다.", "생기부 초안 생성 중 오류가 발생했습니다."
+        return {}, "생기부 초안 생성 중 오류가 발생했습니다.", f"Gemini API 호출 중 오류가 발생했습니다: {e}"
+
+
+def format_submission_text(submission_content):
+    all_submissions_text = ""
+    for activity, content in submission_content.items():
+        all_submissions_text += f"### {activity}\n{content}\n\n"
+    return all_submissions_text
+
+def submission_content_hash(submission_content):
+    """제출 내용이 바뀌었는지 확인하기 위한 해시. 키 순서와 무관합니다."""
+    normalized = json.dumps(submission_content, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def activity_items(activity_data, submission_content):
+    """활동의 입력 칸 중 내용이 있는 것만 {레이블: 내용}으로 모읍니다."""
+    items = {}
+    for part in activity_data['parts']:
+        if part['type'] == 'input':
+            content = submission_content.get(part['label']) or ''
+            if content.strip():
+                items[part['label']] = content
+    return items
+
+def compose_feedback(activity_feedback):
+    """활동별 피드백을 템플릿 순서대로 이어 붙입니다."""
+    return "\n\n".join(f"### {title}\n{part['feedback']}" for title, part in activity_feedback.items())
+
+def get_incremental_feedback(model, class_name, activities, submission_content, previous, limiter=None, cache=None,
+                             on_partial=None, token_budget=PROMPT_TOKEN_BUDGET, on_usage=None, previous_record=None):
+    """내용이 바뀐 활동만 다시 생성하고 나머지는 이전 결과를 재사용합니다.
+
+    previous와 previous_record는 load_activity_feedback()의 결과입니다. 바뀐 활동이
+    있으면 그 활동들의 내용과 참고자료, 나머지 활동의 세특 조각을 한 번의 get_ai_feedback
+    호출로 보내 통합 생기부 초안도 새로 받습니다. (피드백, 생기부 초안, 활동별 결과, 오류
+    메시지)를 반환합니다. 오류가 난 활동은 해시를 비워 다음 제출 때 다시 생성합니다.
+    """
+    parts, changed, exemplars, hashes = {}, {}, {}, {}
+    for title, data in activities.items():
+        items = activity_items(data, submission_content)
+        if not items:
+            continue
+        exemplar = data.get('exemplar_digest', data['exemplar'])
+        content_hash = submission_content_hash(
+            {'items': {label: normalize_text(content) for label, content in items.items()}, 'exemplar': exemplar})
+        if previous.get(title, {}).get('hash') == content_hash:
+            parts[title] = previous[title]
+        else:
+            parts[title] = None  # 템플릿 순서를 지키기 위해 자리만 잡아 둡니다.
+            changed[title], exemplars[title], hashes[title] = items, exemplar, content_hash
+    if not parts:
+        if on_usage is not None:
+            on_usage({'estimated_prompt_tokens': 0, 'token_budget': token_budget, 'prompt_tokens': None,
+                      'output_tokens': None, 'cached': True, 'regenerated': 0, 'reused': 0})
+        return "제출된 내용이 없어 피드백을 생성할 수 없습니다.", "제출된 내용이 없어 생기부 초안을 생성할 수 없습니다.", {}, None
+
+    total = {'estimated_prompt_tokens': 0, 'token_budget': token_budget, 'prompt_tokens': None,
+             'output_tokens': None, 'cached': True, 'regenerated': len(changed), 'reused': len(parts) - len(changed)}
+    record_suggestion, error = previous_record, None
+    if changed:
+        other_records = {title: part['record_suggestion'] for title, part in parts.items()
+                         if part is not None and part.get('record_suggestion')}
+        stream = None
+        if on_partial is not None:
+            stream = lambda partial: on_partial({'feedback': compose_feedback({
+                title: part or {'feedback': partial.get(title, {}).get('feedback', '')} for title, part in parts.items()})})
+        results, record_suggestion, error = get_ai_feedback(
+            model, class_name, changed, exemplars, other_records, limiter, cache,
+            on_partial=stream, token_budget=token_budget, on_usage=lambda usage: total.update(usage),
+        )
+        for title in changed:
+            result = results.get(title, {'feedback': "피드백을 생성하지 못했습니다.", 'record_suggestion': ''})
+            parts[title] = {'hash': '' if error else hashes[title], **result}
+    elif not record_suggestion:
+        # 통합 초안이 저장되지 않은 이전 제출은 활동별 조각을 이어 붙여 대신합니다.
+        record_suggestion = " ".join(part['record_suggestion'] for part in parts.values() if part.get('record_suggestion'))
 
+    if on_usage is not None:
+        on_usage(total)
+    return compose_feedback(parts), record_suggestion, parts, error
+
+def get_overall_assessment(model, class_name, student_id, all_submissions_text, limiter=None, cache=None, on_partial=None):
+    """종합 평가 의견을 생성합니다. (평가 의견, 오류 메시지)를 반환합니다.
+
+    on_partial이 주어지면 스트리밍 중 지금까지 받은 평가 의견을 문자열로 전달합니다.
+    """
+    cache_key = response_cache_key(
+        "assessment", "",
+        {'class_name': class_name, 'student_id': str(student_id), 'submission': normalize_text(all_submissions_text)},
+    )
+    cached = cache.get(cache_key) if cache is not None else None
+    if cached is not None:
+        return cached['assessment'], None
 
-def get_overall_assessment(model, class_name, student_id, all_submissions_text):
     prompt = f"""
 당신은 대한민국 고등학교 교사로서, 학생 한 명의 특정 과목 활동 전체를 종합하여 학교생활기록부 '세부능력 및 특기사항'에 기록할 최종 평가 의견을 작성해야 합니다.
 
@@ -298,35 +2082,327 @@ def get_overall_assessment(model, class_name, student_id, all_submissions_text):
 6.  **결과물 형식**: 반드시 다음 JSON 형식에 맞춰 최종 평가 의견만 한 번에 출력해주세요. {{ "assessment": "여기에 최종 평가 의견을 작성합니다." }}
 """
     try:
-        with st.spinner("AI가 학생의 모든 활동을 종합하여 총평을 생성하고 있습니다..."):
-            response = model.generate_content(prompt)
-            result = json.loads(response.text)
-            return result.get("assessment", "총평을 생성하지 못했습니다.")
+        on_text = None
+        if on_partial is not None and STREAM_RESPONSES:
+            on_text = lambda text: on_partial(extract_partial_json_fields(text, ("assessment",)).get("assessment", ""))
+        response = generate_with_retry(model, prompt, limiter, on_text)
+        result = json.loads(response.text)
+        if cache is not None and "assessment" in result:
+            cache.put(cache_key, {'assessment': result["assessment"]})
+        return result.get("assessment", "총평을 생성하지 못했습니다."), None
+    except json.JSONDecodeError:
+        partial = extract_partial_json_fields(response.text, ("assessment",))
+        if partial.get("assessment"):
+            return partial["assessment"], None
+        return "종합 평가 의견 생성에 실패했습니다.", "AI가 유효한 JSON 형식으로 응답하지 않았습니다."
     except Exception as e:
-        st.error(f"종합 평가 의견 생성 중 API 오류가 발생했습니다: {e}")
-        return "종합 평가 의견 생성에 실패했습니다."
+        return "종합 평가 의견 생성에 실패했습니다.", f"종합 평가 의견 생성 중 API 오류가 발생했습니다: {e}"
+
+# ----------------------------------------------------------------------
+# AI 요청 스케줄링 및 피드백 작업 큐
+# ----------------------------------------------------------------------
+# 동시에 Gemini를 호출하는 작업 수와 프로세스 전체의 분당 요청 한도
+FEEDBACK_WORKERS = 4
+GEMINI_REQUESTS_PER_MINUTE = 15
+GEMINI_MAX_RETRIES = 4
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+FEEDBACK_POLL_INTERVAL = 1
+# 완료된 작업 결과를 보관하는 시간(초)
+FEEDBACK_JOB_RETENTION = 3600
+# 수업 전체 총평 생성 시 기본 동시 요청 수
+ASSESSMENT_PARALLELISM = 4
+
+class RateLimiter:
+    """요청 사이에 최소 간격을 두어 분당 요청 수를 한도 안으로 유지합니다.
+
+    429 응답을 받으면 backoff()로 이후의 모든 요청을 함께 늦춥니다.
+    """
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._next_at - now)
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait:
+            time.sleep(wait)
+
+    def backoff(self, seconds):
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+def generate_with_retry(model, prompt, limiter=None, on_text=None):
+    """generate_content를 호출하고, 429/5xx 응답은 지수 백오프로 다시 시도합니다.
+
+    on_text가 주어지면 스트리밍 API를 사용하고, 조각이 도착할 때마다 지금까지 받은
+    전체 텍스트로 on_text를 호출합니다. 일부라도 받은 뒤의 오류는 다시 시도하지 않습니다.
+    """
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.acquire()
+        received = ""
+        try:
+            with get_metrics().timed("gemini", "generate_content", stream=on_text is not None) as fields:
+                if on_text is None:
+                    response = model.generate_content(prompt)
+                else:
+                    response = model.generate_content(prompt, stream=True)
+                    for chunk in response:
+                        try:
+                            received += chunk.text
+                        except ValueError:
+                            # 텍스트가 없는 조각(안전 필터 등)은 건너뜁니다.
+                            continue
+                        on_text(received)
+                fields['prompt_tokens'], fields['output_tokens'] = response_usage(response)
+            return response
+        except Exception as e:
+            code = getattr(e, 'code', None)
+            if received or attempt == GEMINI_MAX_RETRIES or code not in RETRYABLE_STATUS_CODES:
+                raise
+            delay = 2 ** attempt + random.random()
+            if code == 429 and limiter is not None:
+                limiter.backoff(delay)
+            time.sleep(delay)
+
+class FeedbackQueue:
+    """AI 피드백 요청을 백그라운드 워커에서 처리하는 작업 큐입니다.
+
+    submit()은 작업 ID를 바로 돌려주고, 세션은 status()로 진행 상황을 확인합니다.
+    작업이 끝나면 결과를 save_submission으로 저장합니다.
+    """
+
+    def __init__(self, workers=FEEDBACK_WORKERS, per_minute=GEMINI_REQUESTS_PER_MINUTE):
+        self.limiter = RateLimiter(per_minute)
+        self.cache = get_response_cache()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="feedback")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, model, submissions_store, student_id, class_name, submission_content, activities,
+               token_budget=PROMPT_TOKEN_BUDGET):
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'feedback': None,
+            'record_suggestion': None,
+            'error': None,
+            'partial': {},
+            'usage': None,
+            'finished_at': None,
+        }
+        with self._lock:
+            self._discard_expired()
+            self._jobs[job['id']] = job
+        self._executor.submit(self._run, job, model, submissions_store, student_id, class_name,
+                              dict(submission_content), activities, token_budget)
+        return job['id']
+
+    def _run(self, job, model, submissions_store, student_id, class_name, submission_content, activities, token_budget):
+        job['status'] = 'running'
+        try:
+            previous, previous_record = load_activity_feedback(submissions_store, student_id, class_name)
+            feedback, record_suggestion, activity_feedback, error = get_incremental_feedback(
+                model, class_name, activities, submission_content, previous, self.limiter, self.cache,
+                on_partial=lambda partial: job.update(partial=partial),
+                token_budget=token_budget, on_usage=lambda usage: job.update(usage=usage),
+                previous_record=previous_record,
+            )
+            save_submission(submissions_store, student_id, class_name, submission_content, feedback, record_suggestion,
+                            activity_feedback)
+            write_status = sheet_write_status(submissions_store)
+            if write_status and write_status['stalled']:
+                warning = "제출 내용은 앱에 저장되었지만 구글 시트에 반영하지 못하고 있습니다. 선생님께 알려주세요."
+                error = f"{error}\n{warning}" if error else warning
+            job.update(feedback=feedback, record_suggestion=record_suggestion, error=error, status='done')
+        except Exception as e:
+            job.update(error=f"제출 내용을 저장하는 중 오류가 발생했습니다: {e}", status='failed')
+        finally:
+            job['finished_at'] = time.monotonic()
+
+    def _discard_expired(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] is not None and now - job['finished_at'] > FEEDBACK_JOB_RETENTION]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def pending_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+
+@st.cache_resource(show_spinner=False)
+def get_feedback_queue():
+    return FeedbackQueue()
+
+def class_assessment_targets(submissions_store, assessments_store, class_name, skip_unchanged=True):
+    """총평을 만들 학생 목록을 고릅니다.
+
+    ([(학생 ID, 제출 내용, 내용 해시)], [(학생 ID, 상태, 메시지)])를 반환합니다. 두 번째
+    목록은 읽을 수 없거나 건너뛴 학생이며 상태는 'error' 또는 'skipped'입니다.
+    """
+    targets, results = [], []
+    for student_id in submissions_store.students_in_class(class_name):
+        row = submissions_store.latest_submission(student_id, class_name)
+        try:
+            submission_content = json.loads(row['submission_content']) if row['submission_content'].strip() else {}
+        except json.JSONDecodeError:
+            results.append((student_id, 'error', "제출 내용을 읽을 수 없습니다."))
+            continue
+        if not any(submission_content.values()):
+            results.append((student_id, 'skipped', "제출된 내용이 없습니다."))
+            continue
+        content_hash = submission_content_hash(submission_content)
+        saved = assessments_store.get_assessment(student_id, class_name)
+        if skip_unchanged and saved and saved.get('content_hash') == content_hash:
+            results.append((student_id, 'skipped', "마지막 총평 이후 변경된 내용이 없습니다."))
+            continue
+        targets.append((student_id, submission_content, content_hash))
+    return targets, results
+
+class ClassAssessmentJobs:
+    """수업 전체 총평 생성을 백그라운드 스레드에서 실행합니다.
+
+    학생마다 워커가 총평을 만들고 바로 저장하므로, 교사가 다른 위젯을 누르거나 화면을
+    떠나도 작업이 멈추거나 결과가 사라지지 않습니다. 수업마다 한 번에 하나씩만 실행하며,
+    화면은 latest()로 마지막 작업을 찾아 진행 상황을 보여 줍니다.
+    """
+
+    def __init__(self, limiter, cache):
+        self.limiter = limiter
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._jobs = {}  # 수업 이름 -> 마지막 작업
+
+    def start(self, model, submissions_store, assessments_store, class_name,
+              parallelism=ASSESSMENT_PARALLELISM, skip_unchanged=True):
+        """작업을 시작하고 ID를 반환합니다. 같은 수업의 작업이 이미 실행 중이면 그 ID를 반환합니다."""
+        with self._lock:
+            job = self._jobs.get(class_name)
+            if job is not None and job['status'] == 'running':
+                return job['id']
+            job = {
+                'id': uuid.uuid4().hex,
+                'class_name': class_name,
+                'status': 'running',
+                'total': None,
+                'results': [],
+                'cancelled': False,
+            }
+            self._jobs[class_name] = job
+        threading.Thread(
+            target=self._run,
+            args=(job, model, submissions_store, assessments_store, class_name, parallelism, skip_unchanged),
+            daemon=True,
+        ).start()
+        return job['id']
+
+    def _record(self, job, student_id, status, message):
+        with self._lock:
+            job['results'].append((student_id, status, message))
+
+    def _run(self, job, model, submissions_store, assessments_store, class_name, parallelism, skip_unchanged):
+        try:
+            targets, results = class_assessment_targets(submissions_store, assessments_store, class_name, skip_unchanged)
+            with self._lock:
+                job['total'] = len(targets) + len(results)
+                job['results'].extend(results)
+            with ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="assessment") as executor:
+                for student_id, submission_content, content_hash in targets:
+                    executor.submit(self._assess, job, model, assessments_store, class_name,
+                                    student_id, submission_content, content_hash)
+        except Exception as e:
+            self._record(job, "-", 'error', f"총평 작업 중 오류가 발생했습니다: {e}")
+        finally:
+            with self._lock:
+                job['status'] = 'cancelled' if job['cancelled'] else 'done'
+
+    def _assess(self, job, model, assessments_store, class_name, student_id, submission_content, content_hash):
+        if job['cancelled']:
+            self._record(job, student_id, 'skipped', "취소되었습니다.")
+            return
+        try:
+            assessment, error = get_overall_assessment(
+                model, class_name, student_id, format_submission_text(submission_content), self.limiter, self.cache)
+            if error:
+                self._record(job, student_id, 'error', error)
+                return
+            assessments_store.save_assessment(student_id, class_name, content_hash, assessment)
+            self._record(job, student_id, 'done', assessment)
+        except Exception as e:
+            self._record(job, student_id, 'error', f"총평을 저장하지 못했습니다: {e}")
+
+    def cancel(self, class_name):
+        """아직 시작하지 않은 학생을 건너뜁니다. 이미 보낸 요청은 끝까지 처리해 저장합니다."""
+        with self._lock:
+            job = self._jobs.get(class_name)
+            if job is not None and job['status'] == 'running':
+                job['cancelled'] = True
+
+    def dismiss(self, class_name):
+        """끝난 작업의 결과 표시를 지웁니다."""
+        with self._lock:
+            job = self._jobs.get(class_name)
+            if job is not None and job['status'] != 'running':
+                del self._jobs[class_name]
+
+    def latest(self, class_name):
+        with self._lock:
+            job = self._jobs.get(class_name)
+            return {**job, 'results': list(job['results'])} if job else None
+
+@st.cache_resource(show_spinner=False)
+def get_class_assessment_jobs():
+    return ClassAssessmentJobs(get_feedback_queue().limiter, get_response_cache())
 
 # ----------------------------------------------------------------------
 # UI 렌더링 함수
 # ----------------------------------------------------------------------
-def student_view(submissions_sheet, docs_service, model):
+@st.fragment(run_every=FEEDBACK_POLL_INTERVAL)
+def feedback_job_progress():
+    """제출한 피드백 작업이 끝날 때까지 주기적으로 상태를 확인합니다."""
+    job = get_feedback_queue().status(st.session_state.get('feedback_job'))
+    if job is None:
+        del st.session_state['feedback_job']
+        st.rerun()
+    if job['status'] in ('queued', 'running'):
+        pending = get_feedback_queue().pending_count()
+        st.info(f"제출되었습니다. AI가 피드백과 생기부 초안을 분석하고 있습니다... (처리 대기 {pending}건)")
+        if job['partial'].get('feedback'):
+            with st.expander("🤖 AI 피드백 보기", expanded=True):
+                st.markdown(job['partial']['feedback'])
+        return
+    del st.session_state['feedback_job']
+    if job['error']:
+        st.session_state.feedback_error = job['error']
+    if job['status'] == 'done':
+        st.session_state.feedback = job['feedback']
+        st.session_state.feedback_usage = job['usage']
+        st.session_state.feedback_saved = True
+    st.rerun()
+
+def student_view(submissions_store, docs_service, model):
     st.sidebar.success(f"{st.session_state['user_id']}님, 환영합니다.")
     logout()
     st.sidebar.markdown("---")
-    CLASS_LIST = {
-        "자유 낙하와 수평 방향으로 던진 물체의 운동 비교" : "1AnUqkNgFwO6EwX3p3JaVhk8bOT7-TONIdT9sl-lis_U",
-        "전자기 유도" : "1U9nOSDH3EXF0dX0rvkpiTfk7w61Wy90PDWf-uM9QnHY"
-    }
     if 'current_class' not in st.session_state: st.session_state.current_class = ""
     class_name = st.sidebar.radio("수업 선택", list(CLASS_LIST.keys()), key="class_selector")
     if class_name != st.session_state.current_class:
         st.session_state.current_class = class_name
-        st.session_state.submission_content, st.session_state.feedback = load_previous_submission(submissions_sheet, st.session_state['user_id'], class_name)
-        if 'overall_assessment' in st.session_state: del st.session_state['overall_assessment']
+        st.session_state.submission_content, st.session_state.feedback = load_previous_submission(submissions_store, st.session_state['user_id'], class_name)
+        st.session_state.pop('feedback_usage', None)
     doc_id = CLASS_LIST[class_name]
-    template_text = get_doc_content(docs_service, doc_id)
-    if not template_text: st.stop()
-    activities = parse_template_by_activity(template_text)
+    activities = get_template_cache().get(docs_service, doc_id)
+    if activities is None: st.stop()
     if not activities: st.warning("템플릿에서 '## ' 활동을 찾을 수 없습니다."); st.stop()
     st.sidebar.markdown("---")
     if 'current_activity' not in st.session_state: st.session_state.current_activity = ""
@@ -352,38 +2428,207 @@ def student_view(submissions_sheet, docs_service, model):
             )
     st.markdown("---")
     if st.button("전체 내용 저장 및 AI 피드백 받기", type="primary"):
-        if any(st.session_state.submission_content.values()):
-            all_exemplars = "\n\n".join([f"### {title}\n{data['exemplar']}" for title, data in activities.items() if data['exemplar']])
-            feedback, record_suggestion = get_ai_feedback(model, class_name, st.session_state.submission_content, all_exemplars)
-            st.session_state.feedback = feedback
-            save_submission(submissions_sheet, st.session_state['user_id'], class_name, st.session_state.submission_content, feedback, record_suggestion)
-            st.success("저장 및 피드백 생성이 완료되었습니다!")
+        if st.session_state.get('feedback_job'):
+            st.warning("이전 제출에 대한 피드백을 아직 생성하고 있습니다. 잠시 후 다시 시도해주세요.")
+        elif any(st.session_state.submission_content.values()):
+            st.session_state.feedback_job = get_feedback_queue().submit(
+                model, submissions_store, st.session_state['user_id'], class_name,
+                st.session_state.submission_content, activities, prompt_token_budget()
+            )
         else:
             st.warning("제출할 내용이 없습니다.")
+    if st.session_state.get('feedback_job'):
+        feedback_job_progress()
+    feedback_error = st.session_state.pop('feedback_error', None)
+    if feedback_error:
+        st.error(feedback_error)
+    if st.session_state.pop('feedback_saved', False):
+        st.success("저장 및 피드백 생성이 완료되었습니다!")
     if 'feedback' in st.session_state and st.session_state.feedback:
         with st.expander("🤖 AI 피드백 보기", expanded=True):
             st.markdown(st.session_state.feedback)
+            usage = st.session_state.get('feedback_usage')
+            if usage:
+                if usage['cached']:
+                    st.caption("이전에 생성한 같은 내용의 피드백을 다시 사용했습니다.")
+                else:
+                    prompt_tokens = usage['prompt_tokens'] or f"약 {usage['estimated_prompt_tokens']}"
+                    st.caption(f"입력 토큰 {prompt_tokens} / 요청 예산 {usage['token_budget']}, 출력 토큰 {usage['output_tokens'] or '-'}")
+                st.caption(f"다시 생성한 활동 {usage['regenerated']}개, 이전 피드백을 재사용한 활동 {usage['reused']}개")
+
+def class_assessment_results(job):
+    """총평 작업의 진행률과 학생별 결과를 표시합니다."""
+    icons = {'done': "✅", 'skipped': "⏭️", 'error': "⚠️"}
+    finished, total = len(job['results']), job['total']
+    if total:
+        st.progress(min(finished / total, 1.0), text=f"{finished} / {total}")
+    else:
+        st.progress(0.0, text="대상 학생을 고르고 있습니다...")
+    for student_id, status, message in job['results']:
+        st.markdown(f"{icons[status]} **{student_id}** — {message}")
+
+@st.fragment(run_every=FEEDBACK_POLL_INTERVAL)
+def class_assessment_progress(class_name):
+    """실행 중인 총평 작업을 주기적으로 확인하고, 끝나면 화면 전체를 다시 그립니다."""
+    job = get_class_assessment_jobs().latest(class_name)
+    if job is None or job['status'] != 'running':
+        st.rerun()
+    class_assessment_results(job)
+    if job['cancelled']:
+        st.info("취소 중입니다. 이미 보낸 요청은 끝까지 처리해 저장합니다.")
+    elif st.button("남은 학생 취소", key="cancel_class_assessment"):
+        get_class_assessment_jobs().cancel(class_name)
+
+def class_assessment_section(submissions_store, assessments_store, model, class_name):
+    """수업 전체 학생의 총평을 백그라운드에서 생성하고 진행 상황을 표시합니다."""
+    jobs = get_class_assessment_jobs()
+    job = jobs.latest(class_name)
+    with st.expander("수업 전체 총평 생성", expanded=job is not None):
+        if job is not None and job['status'] == 'running':
+            class_assessment_progress(class_name)
+            return
+        if job is not None:
+            class_assessment_results(job)
+            counts = {status: sum(1 for _, result, _ in job['results'] if result == status)
+                      for status in ('done', 'skipped', 'error')}
+            message = f"완료 {counts['done']}명, 건너뜀 {counts['skipped']}명, 오류 {counts['error']}명"
+            if job['status'] == 'cancelled':
+                st.warning(f"취소되었습니다. {message}")
+            else:
+                st.success(message)
+            if st.button("결과 닫기", key="dismiss_class_assessment"):
+                jobs.dismiss(class_name)
+                st.rerun()
+            st.markdown("---")
+        parallelism = st.slider("동시 요청 수", min_value=1, max_value=8, value=ASSESSMENT_PARALLELISM)
+        skip_unchanged = st.checkbox("마지막 총평 이후 제출 내용이 바뀌지 않은 학생은 건너뛰기", value=True)
+        if st.button("수업 전체 총평 생성하기"):
+            jobs.start(model, submissions_store, assessments_store, class_name,
+                       parallelism=parallelism, skip_unchanged=skip_unchanged)
+            st.rerun()
+
+def template_input_labels(docs_service, class_name):
+    """수업 템플릿의 입력 칸 레이블 목록. 템플릿을 알 수 없으면 빈 목록."""
+    if class_name not in CLASS_LIST:
+        return []
+    activities = get_template_cache().get(docs_service, CLASS_LIST[class_name]) or {}
+    return [part['label'] for activity in activities.values() for part in activity['parts'] if part['type'] == 'input']
+
+def class_analytics_section(users_store, submissions_store, docs_service, class_name):
+    """미리 집계된 통계로 수업의 제출 현황을 보여 줍니다."""
+    summary = submissions_store.class_summary(class_name)
+    if summary is None:
+        return
+    with st.expander("📊 수업 현황", expanded=False):
+        roster = users_store.student_ids()
+        submitted = summary['last_activity']
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("제출 학생 수", summary['submissions'])
+        col2.metric("제출률", f"{len(submitted.keys() & set(roster)) / len(roster):.0%}" if roster else "-")
+        col3.metric("평균 응답 길이", f"{summary['average_length']:.0f}자")
+        col4.metric("마지막 제출", summary['last_timestamp'] or "-")
+
+        labels = template_input_labels(docs_service, class_name)
+        labels += [label for label in summary['label_counts'] if label not in labels]
+        st.markdown("**활동 항목별 작성률** (제출 학생 기준)")
+        st.dataframe({
+            "활동 항목": labels,
+            "작성 학생 수": [summary['label_counts'].get(label, 0) for label in labels],
+            "작성률": [f"{summary['label_counts'].get(label, 0) / summary['submissions']:.0%}" for label in labels],
+        }, hide_index=True, width="stretch")
+
+        recent = sorted(submitted.items(), key=lambda item: item[1], reverse=True)
+        st.markdown("**학생별 마지막 제출 시각**")
+        st.dataframe({
+            "학번": [student_id for student_id, _ in recent],
+            "마지막 제출": [timestamp for _, timestamp in recent],
+        }, hide_index=True, width="stretch")
+
+        not_submitted = [student_id for student_id in roster if student_id not in submitted]
+        st.markdown(f"**미제출 학생** ({len(not_submitted)}명)")
+        st.write(", ".join(not_submitted) if not_submitted else "모든 학생이 제출했습니다.")
 
-def teacher_dashboard(submissions_sheet, model):
+def performance_section(stores):
+    """최근 1시간의 지연 시간, rerun당 API 호출 수, 할당량 사용량과 시트 쓰기 상태를 보여 줍니다."""
+    metrics = get_metrics()
+    write_statuses = [status for status in map(sheet_write_status, stores) if status]
+    for status in write_statuses:
+        if status['stalled']:
+            st.error(f"'{status['sheet']}' 시트에 {status['pending']}건을 {status['failures']}번 연속으로 저장하지 못해 "
+                     f"자동 재시도를 멈췄습니다. 새 제출이 있으면 다시 시도합니다. 마지막 오류: {status['error']}")
+    with st.expander("⏱️ 성능 계측 (최근 1시간)", expanded=False):
+        truncated = metrics.truncated()
+        if truncated:
+            st.warning(f"기록이 보관 한도({METRICS_MAX_RECORDS}건)를 넘어 오래된 기록이 지워졌습니다: "
+                       f"{', '.join(truncated)}. 아래 수치는 최근 1시간보다 짧은 기간의 값입니다.")
+        per_run = metrics.calls_per_run()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("rerun 수", per_run['runs'])
+        col2.metric("rerun당 API 호출 (평균)", f"{per_run['average']:.1f}")
+        col3.metric("rerun당 API 호출 (최대)", per_run['max'])
+
+        quota = metrics.quota_usage()
+        names = {"sheets": "Google Sheets", "docs": "Google Docs", "gemini": "Gemini"}
+        st.markdown("**API 사용량**")
+        st.dataframe({
+            "API": [names[category] for category in quota],
+            "최근 1분": [counts['last_minute'] for counts in quota.values()],
+            "최근 1시간": [counts['window'] for counts in quota.values()],
+        }, hide_index=True, width="stretch")
+        gemini = quota['gemini']
+        st.caption(f"Gemini 분당 한도 {GEMINI_REQUESTS_PER_MINUTE}회 중 {gemini['last_minute']}회 사용, "
+                   f"최근 1시간 입력 토큰 {gemini['prompt_tokens']} / 출력 토큰 {gemini['output_tokens']}")
+
+        if write_statuses:
+            st.markdown("**시트 쓰기 대기**")
+            st.dataframe({
+                "시트": [status['sheet'] for status in write_statuses],
+                "대기 중": [status['pending'] for status in write_statuses],
+                "연속 실패": [status['failures'] for status in write_statuses],
+                "마지막 오류": [status['error'] or "-" for status in write_statuses],
+            }, hide_index=True, width="stretch")
+
+        summary = metrics.latency_summary()
+        st.markdown("**지연 시간**")
+        if not summary:
+            st.write("아직 기록이 없습니다.")
+            return
+        st.dataframe({
+            "분류": [category for category, _ in summary],
+            "작업": [name for _, name in summary],
+            "호출 수": [stats['count'] for stats in summary.values()],
+            "실패": [stats['errors'] for stats in summary.values()],
+            "p50 (ms)": [round(stats['p50'] * 1000) for stats in summary.values()],
+            "p95 (ms)": [round(stats['p95'] * 1000) for stats in summary.values()],
+            "최대 (ms)": [round(stats['max'] * 1000) for stats in summary.values()],
+        }, hide_index=True, width="stretch")
+        st.download_button("계측 기록 내려받기 (JSONL)", data=metrics.export_jsonl(),
+                           file_name="metrics.jsonl", mime="application/json")
+
+def teacher_dashboard(users_store, submissions_store, assessments_store, docs_service, model):
     st.sidebar.warning(f"🧑‍🏫 교사 모드")
     logout()
     st.sidebar.markdown("---")
     st.header("교사 대시보드")
-    submissions_df = pd.DataFrame(submissions_sheet.get_all_records())
-    if submissions_df.empty:
+    if st.sidebar.button("템플릿 새로고침"):
+        get_template_cache().clear()
+        st.sidebar.success("수업 템플릿을 다음 조회 때 새로 불러옵니다.")
+    cache_stats = get_response_cache().stats()
+    st.sidebar.caption(f"AI 응답 캐시: 적중 {cache_stats['hits']}회 / 미적중 {cache_stats['misses']}회 / 저장 {cache_stats['size']}건")
+    st.sidebar.markdown("---")
+    performance_section([users_store, submissions_store, assessments_store])
+    class_names = submissions_store.class_names()
+    if not class_names:
         st.info("아직 제출된 학생 데이터가 없습니다.")
         st.stop()
-    CLASS_LIST = list(submissions_df['class_name'].unique())
-    selected_class = st.sidebar.selectbox("수업 선택", CLASS_LIST)
+    selected_class = st.sidebar.selectbox("수업 선택", class_names)
     if selected_class:
-        students_in_class = list(submissions_df[submissions_df['class_name'] == selected_class]['student_id'].unique())
+        class_analytics_section(users_store, submissions_store, docs_service, selected_class)
+        students_in_class = submissions_store.students_in_class(selected_class)
         selected_student = st.sidebar.selectbox("학생 선택", students_in_class)
         if selected_student:
             st.subheader(f"'{selected_class}' 수업에 대한 {selected_student} 학생의 제출 내용")
-            student_submission = submissions_df[
-                (submissions_df['student_id'].astype(str) == str(selected_student)) &
-                (submissions_df['class_name'] == selected_class)
-            ].sort_values(by='timestamp', ascending=False).iloc[0]
+            student_submission = submissions_store.latest_submission(selected_student, selected_class)
             submission_content = json.loads(student_submission['submission_content'])
             feedback = student_submission['feedback']
             with st.expander("학생 제출 원본 및 개별 피드백 보기", expanded=False):
@@ -396,34 +2641,51 @@ def teacher_dashboard(submissions_sheet, model):
             st.markdown("---")
             st.subheader("종합 평가 의견 (생기부용)")
             if st.button("선택 학생 총평 생성하기", type="primary"):
-                all_submissions_text = ""
-                for activity, content in submission_content.items():
-                    all_submissions_text += f"### {activity}\n{content}\n\n"
-                assessment = get_overall_assessment(model, selected_class, selected_student, all_submissions_text)
-                st.session_state['overall_assessment'] = assessment
-            if 'overall_assessment' in st.session_state and st.session_state.overall_assessment:
-                st.markdown(st.session_state['overall_assessment'])
+                streaming_output = st.empty()
+                with st.spinner("AI가 학생의 모든 활동을 종합하여 총평을 생성하고 있습니다..."):
+                    assessment, error = get_overall_assessment(
+                        model, selected_class, selected_student, format_submission_text(submission_content),
+                        get_feedback_queue().limiter, get_response_cache(), on_partial=streaming_output.markdown,
+                    )
+                streaming_output.empty()
+                if error:
+                    st.error(error)
+                else:
+                    assessments_store.save_assessment(selected_student, selected_class, submission_content_hash(submission_content), assessment)
+            saved_assessment = assessments_store.get_assessment(selected_student, selected_class)
+            if saved_assessment and saved_assessment.get('assessment'):
+                st.markdown(saved_assessment['assessment'])
+                st.caption(f"생성 시각: {saved_assessment.get('timestamp', '')}")
+            st.markdown("---")
+        class_assessment_section(submissions_store, assessments_store, model, selected_class)
 
 # ----------------------------------------------------------------------
 # 메인 실행 로직
 # ----------------------------------------------------------------------
 def main():
+    get_metrics().begin_run()
+    try:
+        warm_start()
+    except Exception:
+        # 연결 오류는 setup_connections에서 표시하고 다시 시도합니다.
+        pass
     gs, docs_service, model = setup_connections()
     if not all([gs, docs_service, model]): st.stop()
 
-    users_sheet = get_sheet(gs, "users")
-    submissions_sheet = get_sheet(gs, "submissions")
-    if not users_sheet or not submissions_sheet: st.stop()
+    storage = get_storage(gs)
+    if storage is None: st.stop()
+    users_store, submissions_store, assessments_store = storage.users, storage.submissions, storage.assessments
+    credentials = get_credential_store(storage.backend, users_store)
 
     if 'logged_in' not in st.session_state or not st.session_state['logged_in']:
-        login(users_sheet)
+        login(credentials)
     else:
         if st.session_state.get('is_teacher', False):
-            teacher_dashboard(submissions_sheet, model)
+            teacher_dashboard(users_store, submissions_store, assessments_store, docs_service, model)
         elif st.session_state.get('password_needs_change', False):
-            change_password_view(users_sheet)
+            change_password_view(credentials)
         else:
-            student_view(submissions_sheet, docs_service, model)
+            student_view(submissions_store, docs_service, model)
 
 if __name__ == "__main__":
     main()
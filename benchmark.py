@@ -0,0 +1,536 @@
+"""app.py 오프라인 벤치마크 및 부하 테스트.
+
+실제 Google Sheets, Docs, Gemini 대신 같은 프로세스 안의 가짜 백엔드를 연결하고,
+Streamlit AppTest로 여러 학생 세션과 교사 세션을 동시에 실행합니다. 작업별 지연 시간과
+API 호출 수를 출력하므로 할당량을 쓰지 않고도 수업 전에 성능 저하를 확인할 수 있습니다.
+
+    python benchmark.py --students 40 --concurrency 40
+    python benchmark.py --json result.json --baseline previous.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import gspread
+import streamlit
+import googleapiclient.discovery
+import google.generativeai as genai
+from google.oauth2.service_account import Credentials
+from streamlit.runtime.secrets import Secrets
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# ----------------------------------------------------------------------
+# 가짜 백엔드
+# ----------------------------------------------------------------------
+# 수업 템플릿이 없을 때 모든 문서 ID에 돌려주는 기본 템플릿
+DEFAULT_TEMPLATE = """## 1. 실험 설계
+실험 목적과 변인을 정리합니다.
+{{가설:실험 가설을 쓰세요}}
+{{변인 통제:통제할 변인과 방법을 쓰세요}}
+<<<exemplar
+가설은 측정 가능한 형태로 쓰고, 조작 변인과 통제 변인을 구분한다.
+>>>
+## 2. 결과 분석
+측정 결과를 해석합니다.
+{{결과 해석:그래프의 경향을 설명하세요}}
+<<<exemplar
+그래프의 기울기가 의미하는 물리량을 밝히고 오차 원인을 두 가지 이상 제시한다.
+>>>"""
+
+class QuotaExceeded(Exception):
+    """가짜 백엔드의 분당 한도를 넘었을 때. Gemini 클라이언트처럼 code=429를 가집니다."""
+    code = 429
+
+class FakeService:
+    """한 API의 지연 시간과 분당 호출 한도를 흉내 내고 작업별 호출 수를 셉니다.
+
+    per_minute가 0이면 한도가 없습니다. 한도를 넘은 호출은 QuotaExceeded를 던지고
+    'rate_limited'로 따로 셉니다.
+    """
+
+    def __init__(self, name, latency, per_minute=0, jitter=0.2):
+        self.name = name
+        self.latency = latency
+        self.per_minute = per_minute
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self._recent = []
+        self.counts = {}
+
+    def call(self, operation):
+        with self._lock:
+            now = time.monotonic()
+            self._recent = [at for at in self._recent if now - at < 60]
+            if self.per_minute and len(self._recent) >= self.per_minute:
+                self.counts['rate_limited'] = self.counts.get('rate_limited', 0) + 1
+                raise QuotaExceeded(f"{self.name}: 분당 {self.per_minute}회 한도 초과")
+            self._recent.append(now)
+            self.counts[operation] = self.counts.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+class FakeWorksheet:
+    """gspread Worksheet 중 app.py가 쓰는 메서드만 구현합니다. 값은 모두 문자열로 보관합니다."""
+
+    def __init__(self, service, title, rows=None, cols=20):
+        self.service = service
+        self.title = title
+        self._lock = threading.Lock()
+        self._rows = [[str(value) for value in row] for row in rows or []]
+        self._cols = cols
+
+    @property
+    def col_count(self):
+        return max([self._cols] + [len(row) for row in self._rows])
+
+    def get_all_values(self):
+        self.service.call("read")
+        with self._lock:
+            return [list(row) for row in self._rows]
+
+    def batch_get(self, ranges):
+        """"A:A" 같은 열 범위만 지원합니다. 빈 칸은 빈 목록으로 돌려줍니다."""
+        self.service.call("read")
+        with self._lock:
+            columns = []
+            for range_name in ranges:
+                col = gspread.utils.a1_to_rowcol(range_name.split(':')[0] + "1")[1]
+                columns.append([[row[col - 1]] if len(row) >= col and row[col - 1] else [] for row in self._rows])
+            return columns
+
+    def row_values(self, row):
+        self.service.call("read")
+        with self._lock:
+            return list(self._rows[row - 1]) if row <= len(self._rows) else []
+
+    def append_row(self, values):
+        self.append_rows([values])
+
+    def append_rows(self, values):
+        self.service.call("write")
+        with self._lock:
+            self._rows.extend([str(value) for value in row] for row in values)
+
+    def update(self, range_name, values):
+        self.service.call("write")
+        self._set_range(range_name, values)
+
+    def batch_update(self, data):
+        self.service.call("write")
+        for item in data:
+            self._set_range(item['range'], item['values'])
+
+    def add_cols(self, cols):
+        self.service.call("write")
+        self._cols = self.col_count + cols
+
+    def _set_range(self, range_name, values):
+        row, col = gspread.utils.a1_to_rowcol(range_name.split(':')[0])
+        with self._lock:
+            for i, row_values in enumerate(values):
+                while len(self._rows) < row + i:
+                    self._rows.append([])
+                target = self._rows[row + i - 1]
+                for j, value in enumerate(row_values):
+                    while len(target) < col + j:
+                        target.append('')
+                    target[col + j - 1] = str(value)
+
+class FakeSpreadsheet:
+    def __init__(self, service, worksheets):
+        self.service = service
+        self._worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+
+    def worksheets(self):
+        self.service.call("read")
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows, cols):
+        self.service.call("write")
+        worksheet = FakeWorksheet(self.service, title, cols=int(cols))
+        self._worksheets[title] = worksheet
+        return worksheet
+
+class FakeGspreadClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open_by_key(self, key):
+        self.spreadsheet.service.call("read")
+        return self.spreadsheet
+
+class FakeDocsService:
+    """docs_service.documents().get(...).execute()를 흉내 냅니다."""
+
+    def __init__(self, service, template_text, revision_id="1"):
+        self.service = service
+        self.template_text = template_text
+        self.revision_id = revision_id
+
+    def documents(self):
+        return self
+
+    def get(self, documentId, fields=None):
+        return SimpleNamespace(execute=lambda: self._execute(fields))
+
+    def _execute(self, fields):
+        self.service.call("get_revision" if fields == 'revisionId' else "get")
+        if fields == 'revisionId':
+            return {'revisionId': self.revision_id}
+        content = [{'paragraph': {'elements': [{'textRun': {'content': line}}]}}
+                   for line in self.template_text.split('\n')]
+        return {'revisionId': self.revision_id, 'body': {'content': content}}
+
+class FakeStream:
+    """stream=True 응답. 반복이 끝나면 text와 usage_metadata를 읽을 수 있습니다."""
+
+    def __init__(self, text, usage_metadata, chunk_size=40):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self._chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield SimpleNamespace(text=chunk)
+
+class FakeModel:
+    """JSON 모드 Gemini 모델을 흉내 냅니다. 토큰 수는 글자 수로 어림합니다."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def generate_content(self, prompt, stream=False):
+        self.service.call("generate_content")
+        if '"feedback"' in prompt:
+            activities = re.findall(r"^### 활동: (.+)$", prompt, re.MULTILINE)
+            text = json.dumps({
+                'activities': {title: {
+                    'feedback': "가설이 분명하고 변인 통제 방법이 구체적입니다. 측정 횟수를 늘려 보세요.",
+                    'record_suggestion': "실험 설계 과정에서 변인을 체계적으로 통제함.",
+                } for title in activities},
+                'record_suggestion': "실험 설계 과정에서 변인을 체계적으로 통제하고 자료를 근거로 결론을 도출함.",
+            }, ensure_ascii=False)
+        else:
+            text = json.dumps({'assessment': "탐구 전 과정에서 자료를 근거로 결론을 도출하는 능력이 돋보임."},
+                              ensure_ascii=False)
+        usage = SimpleNamespace(prompt_token_count=len(prompt) // 2, candidates_token_count=len(text) // 2)
+        if stream:
+            return FakeStream(text, usage)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+class FakeCredentials:
+    valid = True
+
+    def __init__(self):
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    def refresh(self, request):
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+class FakeBackend:
+    """벤치마크 한 번에 쓰는 가짜 Sheets, Docs, Gemini 묶음입니다."""
+
+    def __init__(self, students, args):
+        self.sheets = FakeService("sheets", args.sheets_latency, args.sheets_per_minute)
+        self.docs = FakeService("docs", args.docs_latency, args.docs_per_minute)
+        self.gemini = FakeService("gemini", args.gemini_latency, args.gemini_per_minute)
+        users = FakeWorksheet(self.sheets, "users", [["student_id", "password", "password_changed"]] +
+                              [[student_id, password, "TRUE"] for student_id, password in students])
+        self.gs = FakeGspreadClient(FakeSpreadsheet(self.sheets, [users]))
+        self.docs_service = FakeDocsService(self.docs, DEFAULT_TEMPLATE)
+        self.model = FakeModel(self.gemini)
+
+    def install(self, stack):
+        """app.py가 사용하는 클라이언트 생성 함수를 가짜 백엔드로 바꿉니다."""
+        stack.enter_context(mock.patch.object(Credentials, "from_service_account_info",
+                                              lambda info, scopes=None: FakeCredentials()))
+        stack.enter_context(mock.patch.object(gspread, "authorize", lambda creds: self.gs))
+        stack.enter_context(mock.patch.object(googleapiclient.discovery, "build",
+                                              lambda *args, **kwargs: self.docs_service))
+        stack.enter_context(mock.patch.object(genai, "configure", lambda **kwargs: None))
+        stack.enter_context(mock.patch.object(genai, "GenerativeModel",
+                                              lambda name, generation_config=None: self.model))
+
+    def api_counts(self):
+        return {service.name: dict(service.counts) for service in (self.sheets, self.docs, self.gemini)}
+
+# ----------------------------------------------------------------------
+# 세션 시뮬레이션
+# ----------------------------------------------------------------------
+# AppTest.run()은 전역 Runtime과 st.secrets를 바꿔 끼우므로 동시에 실행할 수 없습니다.
+# rerun은 이 잠금으로 하나씩 실행하고, 피드백 작업과 시트 flush 같은 백그라운드 처리는
+# 실제 서버처럼 동시에 진행됩니다. 측정하는 rerun 시간에는 잠금 대기가 들어가지 않습니다.
+APPTEST_LOCK = threading.Lock()
+TEACHER_ID = "teacher"
+TEACHER_PASSWORD = "benchmark"
+SUBMIT_LABEL = "전체 내용 저장 및 AI 피드백 받기"
+STUDENT_ASSESSMENT_LABEL = "선택 학생 총평 생성하기"
+CLASS_ASSESSMENT_LABEL = "수업 전체 총평 생성하기"
+
+def app_secrets(storage_backend, sqlite_path):
+    """모든 세션이 함께 쓰는 st.secrets 내용."""
+    account_fields = ["type", "project_id", "private_key_id", "private_key", "client_email", "client_id",
+                      "auth_uri", "token_uri", "auth_provider_x509_cert_url", "client_x509_cert_url"]
+    return {
+        "gcp_service_account": {field: "benchmark" for field in account_fields},
+        "google_sheet_key": {"sheet_key": "benchmark"},
+        "gemini_api_key": {"api_key": "benchmark"},
+        "teacher_account": {"id": TEACHER_ID, "password": TEACHER_PASSWORD},
+        "storage": {"backend": storage_backend, "sqlite_path": sqlite_path},
+    }
+
+class Timings:
+    """작업 이름별 소요 시간(초)과 실패 수를 모읍니다."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, operation, seconds, ok=True):
+        with self._lock:
+            self.samples.setdefault(operation, []).append(seconds)
+            if not ok:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def summary(self):
+        result = {}
+        for operation, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            rank = lambda q: samples[max(0, math.ceil(q * len(samples)) - 1)]
+            result[operation] = {'count': len(samples), 'errors': self.errors.get(operation, 0),
+                                 'p50': rank(0.5), 'p95': rank(0.95), 'max': samples[-1]}
+        return result
+
+class Session:
+    """AppTest 하나가 브라우저 탭 하나에 해당합니다. run()마다 한 번의 rerun을 측정합니다.
+
+    secrets는 AppTest.secrets 대신 run_benchmark에서 전역으로 한 번만 설정합니다.
+    """
+
+    def __init__(self, app_path, timings, timeout):
+        self.at = AppTest.from_file(app_path, default_timeout=timeout)
+        self.timings = timings
+
+    def run(self, operation):
+        with APPTEST_LOCK:
+            started = time.perf_counter()
+            try:
+                self.at.run()
+                ok = not self.at.exception and not self.at.error
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+        self.timings.record(operation, elapsed, ok)
+        return ok
+
+    def login(self, user_id, password):
+        self.run("open")
+        self.at.text_input[0].input(user_id)
+        self.at.text_input[1].input(password)
+        self.at.button[0].click()
+        return self.run("login")
+
+    def button(self, label):
+        return next(button for button in self.at.button if button.label == label)
+
+    def has_state(self, key):
+        try:
+            return key in self.at.session_state
+        except Exception:
+            return False
+
+def student_session(app_path, timings, args, student_id, password):
+    """로그인 → 답안 작성 → 제출 → 피드백 완료까지 기다리기를 rounds번 반복합니다.
+
+    두 번째 제출부터는 첫 입력 칸만 고쳐 활동별 증분 피드백 경로를 측정합니다.
+    """
+    time.sleep(random.uniform(0, args.ramp))
+    session = Session(app_path, timings, args.timeout)
+    if not session.login(student_id, password):
+        return
+    for round_number in range(args.rounds):
+        for index, text_area in enumerate(session.at.text_area):
+            if round_number == 0 or index == 0:
+                text_area.input(f"{student_id} {text_area.label} 답안 {round_number} " * args.answer_repeat)
+        session.button(SUBMIT_LABEL).click()
+        submitted_at = time.perf_counter()
+        session.run("submit")
+        deadline = time.monotonic() + args.feedback_timeout
+        while session.has_state('feedback_job') and time.monotonic() < deadline:
+            time.sleep(args.poll_interval)
+            session.run("poll")
+        finished = not session.has_state('feedback_job')
+        timings.record("feedback_round_trip", time.perf_counter() - submitted_at, finished)
+
+def class_assessment_summary(session):
+    """수업 전체 총평 작업이 끝났으면 결과 요약 문구, 아직이면 None."""
+    for element in list(session.at.success) + list(session.at.warning):
+        if "건너뜀" in element.value:
+            return element.value
+    return None
+
+def teacher_assessments(session, timings, args):
+    """선택 학생 총평을 만든 뒤 수업 전체 총평 작업을 시작하고 끝날 때까지 기다립니다."""
+    session.button(STUDENT_ASSESSMENT_LABEL).click()
+    session.run("student_assessment")
+    session.button(CLASS_ASSESSMENT_LABEL).click()
+    started = time.perf_counter()
+    session.run("class_assessment_start")
+    deadline = time.monotonic() + args.assessment_timeout
+    summary = class_assessment_summary(session)
+    while summary is None and time.monotonic() < deadline:
+        time.sleep(args.poll_interval)
+        session.run("class_assessment_poll")
+        summary = class_assessment_summary(session)
+    ok = summary is not None and "오류 0명" in summary
+    timings.record("class_assessment_round_trip", time.perf_counter() - started, ok)
+
+def teacher_session(app_path, timings, args, students_done):
+    """학생들이 제출하는 동안 대시보드를 주기적으로 새로 고치고, 끝나면 총평을 생성한 뒤 계측 표를 읽습니다."""
+    session = Session(app_path, timings, args.timeout)
+    session.login(TEACHER_ID, TEACHER_PASSWORD)
+    while not students_done.wait(args.teacher_interval):
+        session.run("teacher_dashboard")
+    session.run("teacher_dashboard")
+    if args.assessments:
+        teacher_assessments(session, timings, args)
+    for dataframe in session.at.dataframe:
+        table = dataframe.value
+        if "작업" in table.columns:
+            return table.to_dict(orient="records")
+    return []
+
+# ----------------------------------------------------------------------
+# 실행 및 보고
+# ----------------------------------------------------------------------
+def run_benchmark(args):
+    students = [(f"s{number:03d}", f"pw{number:03d}") for number in range(1, args.students + 1)]
+    backend = FakeBackend(students, args)
+    timings = Timings()
+    workdir = tempfile.mkdtemp(prefix="feedback-benchmark-")
+    try:
+        # 응답 캐시와 SQLite 파일이 저장소의 파일을 건드리지 않도록 복사본을 실행합니다.
+        app_path = shutil.copy(APP_PATH, workdir)
+        sqlite_path = os.path.join(workdir, "feedback.sqlite3")
+        secrets = Secrets()
+        secrets._secrets = app_secrets(args.storage, sqlite_path)
+        students_done = threading.Event()
+        app_metrics = []
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            backend.install(stack)
+            stack.enter_context(mock.patch.object(streamlit, "secrets", secrets))
+            teacher = threading.Thread(
+                target=lambda: app_metrics.extend(teacher_session(app_path, timings, args, students_done)))
+            teacher.start()
+            semaphore = threading.Semaphore(args.concurrency)
+
+            def limited(student_id, password):
+                with semaphore:
+                    try:
+                        student_session(app_path, timings, args, student_id, password)
+                    except Exception as e:
+                        timings.record("session_crash", 0.0, ok=False)
+                        print(f"{student_id} 세션 중단: {e!r}", file=sys.stderr)
+
+            threads = [threading.Thread(target=limited, args=student) for student in students]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            students_done.set()
+            teacher.join()
+        return {
+            'config': vars(args),
+            'elapsed': time.perf_counter() - started,
+            'operations': timings.summary(),
+            'api_calls': backend.api_counts(),
+            'app_metrics': app_metrics,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_report(report):
+    print(f"\n총 소요 시간 {report['elapsed']:.1f}초 (학생 {report['config']['students']}명, "
+          f"동시 {report['config']['concurrency']}명, 저장소 {report['config']['storage']})")
+    print("\n[작업별 지연 시간 (초)]")
+    print(f"{'작업':<30}{'횟수':>6}{'실패':>6}{'p50':>9}{'p95':>9}{'최대':>9}")
+    for operation, stats in report['operations'].items():
+        print(f"{operation:<30}{stats['count']:>6}{stats['errors']:>6}"
+              f"{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['max']:>9.3f}")
+    print("\n[가짜 백엔드 API 호출 수]")
+    for service, counts in report['api_calls'].items():
+        print(f"{service:<8}" + ", ".join(f"{operation} {count}" for operation, count in sorted(counts.items())))
+    if report['app_metrics']:
+        print("\n[앱 내부 계측 (교사 대시보드 성능 계측 표)]")
+        for row in report['app_metrics']:
+            print("  " + ", ".join(f"{key} {value}" for key, value in row.items()))
+
+def compare_with_baseline(report, baseline, tolerance):
+    """기준 결과보다 p95가 tolerance 비율 이상 늘어난 작업 목록."""
+    regressions = []
+    for operation, stats in report['operations'].items():
+        previous = baseline.get('operations', {}).get(operation)
+        if previous and stats['p95'] > previous['p95'] * (1 + tolerance):
+            regressions.append((operation, previous['p95'], stats['p95']))
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="가짜 백엔드로 app.py의 동시 접속 성능을 측정합니다.")
+    parser.add_argument("--students", type=int, default=40, help="학생 세션 수")
+    parser.add_argument("--concurrency", type=int, default=40, help="동시에 실행할 학생 세션 수")
+    parser.add_argument("--rounds", type=int, default=2, help="학생마다 제출하는 횟수")
+    parser.add_argument("--ramp", type=float, default=10.0, help="학생 세션 시작을 흩뜨리는 시간(초)")
+    parser.add_argument("--answer-repeat", type=int, default=20, help="답안 문장을 반복하는 횟수")
+    parser.add_argument("--storage", default="sheets", help="app.py의 [storage] backend 값")
+    parser.add_argument("--sheets-latency", type=float, default=0.3)
+    parser.add_argument("--docs-latency", type=float, default=0.4)
+    parser.add_argument("--gemini-latency", type=float, default=2.0)
+    parser.add_argument("--sheets-per-minute", type=int, default=300, help="0이면 한도 없음")
+    parser.add_argument("--docs-per-minute", type=int, default=300, help="0이면 한도 없음")
+    parser.add_argument("--gemini-per-minute", type=int, default=60, help="0이면 한도 없음")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="피드백 완료를 확인하는 주기(초)")
+    parser.add_argument("--feedback-timeout", type=float, default=600.0, help="피드백 한 번을 기다리는 최대 시간(초)")
+    parser.add_argument("--no-assessments", dest="assessments", action="store_false",
+                        help="학생 제출이 끝난 뒤 총평 생성을 측정하지 않습니다")
+    parser.add_argument("--assessment-timeout", type=float, default=600.0, help="수업 전체 총평을 기다리는 최대 시간(초)")
+    parser.add_argument("--teacher-interval", type=float, default=5.0, help="교사 대시보드를 새로 고치는 주기(초)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="rerun 한 번의 제한 시간(초)")
+    parser.add_argument("--json", help="결과를 저장할 JSON 파일")
+    parser.add_argument("--baseline", help="비교할 이전 결과 JSON 파일")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p95 증가를 허용하는 비율")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        for operation, previous, current in regressions:
+            print(f"성능 저하: {operation} p95 {previous:.3f}초 → {current:.3f}초")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())